@@ -0,0 +1,106 @@
+#!/usr/bin/python
+import argparse
+import random
+import time as timer
+from single_agent_planner import UNREACHABLE, compile_map, a_star, build_constraint_table, compute_heuristics
+from heuristics import LandmarkHeuristics
+
+# Compares the landmark heuristic against the exact distance tables: node
+# expansions of a_star on random start/goal pairs, and memory of the tables.
+
+MOVINGAI_MAP = '../CBSH2-RTC/random-32-32-20.map'
+
+
+def import_movingai_map(filename):
+    """Read a map in the movingai format (header, then one line per row)."""
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    height = int(lines[1].split()[1])
+    width = int(lines[2].split()[1])
+    my_map = []
+    for line in lines[4:4 + height]:
+        # '.', 'G' and 'S' are passable, the other terrains are obstacles
+        my_map.append([cell not in '.GS' for cell in line[:width]])
+    return my_map
+
+
+def generate_map(rows, cols, obstacle_ratio, seed):
+    rng = random.Random(seed)
+    return [[rng.random() < obstacle_ratio for _ in range(cols)] for _ in range(rows)]
+
+
+def sample_queries(graph, num_queries, seed):
+    """Return random (start, goal) pairs of free cells connected to each other,
+    along with the exact h_values of each goal."""
+    rng = random.Random(seed)
+    free = [loc for cell, loc in enumerate(graph['locs']) if graph['free'][cell]]
+    queries = []
+    while len(queries) < num_queries:
+        goal = rng.choice(free)
+        h_values = compute_heuristics(graph, goal)
+        reachable = [loc for loc in free if h_values[loc[0] * graph['cols'] + loc[1]] != UNREACHABLE]
+        if len(reachable) > 1:
+            queries.append((rng.choice(reachable), goal, h_values))
+    return queries
+
+
+def run_queries(graph, queries, heuristics):
+    """Return the search statistics of a_star over the queries; heuristics is
+    None for the exact tables."""
+    constraint_table = build_constraint_table([], 0, graph)
+    stats = {}
+    start_time = timer.time()
+    for start, goal, h_values in queries:
+        if heuristics is not None:
+            h_values = heuristics[goal]
+        a_star(graph, start, goal, h_values, 0, constraint_table, stats)
+    stats['time'] = timer.time() - start_time
+    return stats
+
+
+def benchmark(name, my_map, args):
+    graph = compile_map(my_map)
+    n = graph['num_cells']
+    queries = sample_queries(graph, args.queries, args.seed)
+    num_goals = len({goal for _, goal, _ in queries})
+    print('{} ({}x{}, {} free cells, {} queries)'.format(name, graph['rows'], graph['cols'],
+                                                         sum(graph['free']), len(queries)))
+    print('  {:<14}{:>12}{:>10}{:>10}{:>14}{:>14}'.format('heuristic', 'expanded', 'ratio', 'time',
+                                                          'setup', 'memory (MB)'))
+    exact = run_queries(graph, queries, None)
+    print('  {:<14}{:>12}{:>10.2f}{:>10.2f}{:>14}{:>14.2f}'.format('all-pairs', exact['expanded'], 1, exact['time'],
+                                                                   '-', 2 * n * n / 2 ** 20))
+    print('  {:<14}{:>12}{:>10.2f}{:>10.2f}{:>14}{:>14.2f}'.format('per-goal', exact['expanded'], 1, exact['time'],
+                                                                   '-', 2 * n * num_goals / 2 ** 20))
+    for num_landmarks in args.landmarks:
+        start_time = timer.time()
+        # the derived tables are not cached, so that only the landmarks are in memory
+        heuristics = LandmarkHeuristics(graph, 2 * n * (num_landmarks + 1), num_landmarks)
+        setup = timer.time() - start_time
+        stats = run_queries(graph, queries, heuristics)
+        print('  {:<14}{:>12}{:>10.2f}{:>10.2f}{:>14.2f}{:>14.2f}'.format(
+            'landmarks={}'.format(num_landmarks), stats['expanded'], stats['expanded'] / max(1, exact['expanded']),
+            stats['time'], setup, 2 * n * len(heuristics.landmarks) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the landmark heuristic with the exact distance tables')
+    parser.add_argument('--map', type=str, default=MOVINGAI_MAP,
+                        help='Map in the movingai format, defaults to ' + MOVINGAI_MAP)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[64, 128, 256],
+                        help='Sizes of the generated square maps')
+    parser.add_argument('--obstacles', type=float, default=0.2,
+                        help='Obstacle ratio of the generated maps')
+    parser.add_argument('--landmarks', type=int, nargs='+', default=[4, 8, 16],
+                        help='Numbers of landmarks to compare')
+    parser.add_argument('--queries', type=int, default=100,
+                        help='Number of start/goal pairs per map')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated maps and queries')
+    args = parser.parse_args()
+
+    if args.map:
+        benchmark(args.map, import_movingai_map(args.map), args)
+    for size in args.sizes:
+        benchmark('random-{0}-{0}-{1:g}'.format(size, 100 * args.obstacles),
+                  generate_map(size, size, args.obstacles, args.seed + size), args)
@@ -1,24 +1,22 @@
 import random
 import time as timer
 import heapq
-from single_agent_planner import compute_heuristics, a_star, get_location, get_sum_of_cost
+from single_agent_planner import compile_map, a_star_waypoints, build_constraint_table, build_conflict_table, \
+    add_constraint, copy_constraint_table, paths_violate_constraint, get_location, get_sum_of_cost
+from heuristics import HEURISTICS_CACHE_DIR, LAZY_MEMORY_BUDGET, NUM_LANDMARKS, build_heuristics
+from mdd import NON_CARDINAL, MDDCache, classify_collision
+from cbs_heuristic import CBSHeuristic
+from rectangle_reasoning import RectangleReasoning
+from corridor_reasoning import CorridorReasoning
+from meta_agent_planner import META_AGENT_NODE_LIMIT, plan_meta_agent
+from station_assignment import STATION_LOAD_PENALTY, assign_stations
+from station_schedule import STATION_CAPACITY, STATION_THROUGHPUT, detect_station_conflicts, \
+    get_release_constraints, get_station_statistics, schedule_releases
 
 DEBUG = True
 
 
-def normalize_paths(pathA, pathB):
-    """
-    given path1 and path2, finds the shortest path and pads it with the last location
-    """
-    path1 = pathA.copy()
-    path2 = pathB.copy()
-    shortest, pad = (path1, len(path2) - len(path1)) if len(path1) < len(path2) else (path2, len(path1) - len(path2))
-    for _ in range(pad):
-        shortest.append(shortest[-1])
-    return path1, path2
-
-
-def detect_collision(pathA, pathB, inbound_stations, outbound_stations):
+def detect_collision(pathA, pathB, stations):
     ##############################
     # Task 3.1: Return the first collision that occurs between two robot paths (or None if there is no collision)
     #           There are two types of collisions: vertex collision and edge collision.
@@ -26,45 +24,126 @@ def detect_collision(pathA, pathB, inbound_stations, outbound_stations):
     #           An edge collision occurs if the robots swap their location at the same timestep.
     #           You should use "get_location(path, t)" to get the location of a robot at time t.
     # this function detects if an agent collides with another even after one of the two reached the goal
-    path1, path2 = normalize_paths(pathA, pathB)
-    ignore_stations = inbound_stations + outbound_stations
-    length = len(path1)
+    # stations is the set of the station locations, where agents never have vertex collisions
+    length = max(len(pathA), len(pathB))
     for t in range(length):
         # check for vertex collision
-        pos1 = get_location(path1, t)
-        pos2 = get_location(path2, t)
-        if pos1 == pos2 and pos1 not in ignore_stations:
+        pos1 = get_location(pathA, t)
+        pos2 = get_location(pathB, t)
+        if pos1 == pos2 and pos1 not in stations:
             # we return the vertex and the timestep causing the collision
             return [pos1], t, 'vertex'
         # check for edge collision (not if we are in the last timestep)
         if t < length - 1:
-            next_pos1 = get_location(path1, t + 1)
-            next_pos2 = get_location(path2, t + 1)
-            if pos1 == next_pos2 and pos2 == next_pos1 and pos1 not in ignore_stations and next_pos1 not in ignore_stations:
+            next_pos1 = get_location(pathA, t + 1)
+            next_pos2 = get_location(pathB, t + 1)
+            if pos1 == next_pos2 and pos2 == next_pos1 and pos1 != next_pos1:
                 # we return the edge and timestep causing the collision
                 return [next_pos2, next_pos1], t + 1, 'edge'
     return None
 
 
-def detect_collisions(paths, inbound_stations, outbound_stations):
+def add_collision(first_collisions, a1, a2, order, loc, timestep, collision_type):
+    """Keep the collision if it is the first one found between a1 and a2 so far."""
+    pair = (a1, a2) if a1 < a2 else (a2, a1)
+    current = first_collisions.get(pair)
+    if current is None or order < current[0]:
+        first_collisions[pair] = (order, {'a1': pair[0], 'a2': pair[1], 'loc': loc,
+                                          'timestep': timestep, 'type': collision_type})
+
+
+def detect_collisions(paths, stations):
     ##############################
     # Task 3.1: Return a list of first collisions between all robot pairs.
     #           A collision can be represented as dictionary that contains the id of the two robots, the vertex or edge
     #           causing the collision, and the timestep at which the collision occurred.
-    #           You should use your detect_collision function to find a collision between two robots.
-    collisions = []
-    for i in range(len(paths)):
-        for j in range(i + 1, len(paths)):
-            coll_data = detect_collision(paths[i], paths[j], inbound_stations, outbound_stations)
-            # if coll_data is not None (collision detected)
-            if coll_data:
-                collisions.append({
-                    'a1': i,
-                    'a2': j,
-                    'loc': coll_data[0],  # vertex or edge
-                    'timestep': coll_data[1],  # timestep
-                    'type': coll_data[2]
-                })
+    # The paths are indexed by (location, timestep) and by (edge, timestep), so
+    # only the agents that share a location or an edge at some timestep are
+    # compared. The collisions are the ones detect_collision finds, in the same
+    # order: an agent stays at its goal after the end of its path, and at a
+    # given timestep t a vertex collision comes before an edge collision
+    # between t and t + 1, which comes before a vertex collision at t + 1.
+    # stations is the set of the station locations, where agents never have vertex collisions
+    first_collisions = dict()
+    vertices = dict()
+    edges = dict()
+    # agents waiting at their goal location, from the end of their path on
+    parked = dict()
+    for agent, path in enumerate(paths):
+        if len(path) > 0 and path[-1] not in stations:
+            parked.setdefault(path[-1], []).append((agent, len(path) - 1))
+    for agent, path in enumerate(paths):
+        prev_loc = None
+        for t, loc in enumerate(path):
+            if loc not in stations:
+                occupants = vertices.setdefault((loc, t), [])
+                for other in occupants:
+                    add_collision(first_collisions, other, agent, 2 * t, [loc], t, 'vertex')
+                occupants.append(agent)
+                for other, since in parked.get(loc, ()):
+                    if other != agent and since <= t:
+                        add_collision(first_collisions, other, agent, 2 * t, [loc], t, 'vertex')
+            if prev_loc is not None and prev_loc != loc:
+                # the other agent moved the opposite way: the edge is given in its direction
+                for other in edges.get((loc, prev_loc, t), ()):
+                    add_collision(first_collisions, other, agent, 2 * t - 1, [loc, prev_loc], t, 'edge')
+                edges.setdefault((prev_loc, loc, t), []).append(agent)
+            prev_loc = loc
+    return [first_collisions[pair][1] for pair in sorted(first_collisions)]
+
+
+def detect_agent_collisions(paths, agent, path, stations):
+    """Return the first collision between agent, following path, and each of
+    the other agents, as detect_collisions finds them (paths[agent] is not
+    used). Only the path of agent is indexed, and the path of every other
+    agent is scanned until its first collision.
+    stations    - set of the station locations, where agents never have vertex collisions
+    """
+    first_collisions = dict()
+    vertices = set()
+    edges = set()
+    # timesteps at which agent is at each location, in increasing order
+    visits = dict()
+    for t, loc in enumerate(path):
+        if loc not in stations:
+            vertices.add((loc, t))
+            visits.setdefault(loc, []).append(t)
+        if t > 0 and path[t - 1] != loc:
+            edges.add((path[t - 1], loc, t))
+    goal = path[-1]
+    arrival = len(path) - 1
+    for other, other_path in enumerate(paths):
+        if other == agent:
+            continue
+        prev_loc = None
+        for t, loc in enumerate(other_path):
+            # at timestep t, an edge collision comes before a vertex collision
+            if prev_loc is not None and prev_loc != loc and (loc, prev_loc, t) in edges:
+                edge = [loc, prev_loc] if agent < other else [prev_loc, loc]
+                add_collision(first_collisions, agent, other, 2 * t - 1, edge, t, 'edge')
+                break
+            if loc not in stations and ((loc, t) in vertices or (loc == goal and t >= arrival)):
+                add_collision(first_collisions, agent, other, 2 * t, [loc], t, 'vertex')
+                break
+            prev_loc = loc
+        else:
+            # agent moves through the goal of the other agent after its arrival
+            other_arrival = len(other_path) - 1
+            for t in visits.get(other_path[-1], ()):
+                if t >= other_arrival:
+                    add_collision(first_collisions, agent, other, 2 * t, [other_path[-1]], t, 'vertex')
+                    break
+    return [first_collisions[pair][1] for pair in sorted(first_collisions)]
+
+
+def update_collisions(collisions, paths, agent, path, stations):
+    """Return the collisions once the path of agent is replaced by path, given
+    the collisions of paths: the collisions of agent are detected again, the
+    others are kept.
+    """
+    collisions = [collision for collision in collisions if collision['a1'] != agent and collision['a2'] != agent]
+    collisions += detect_agent_collisions(paths, agent, path, stations)
+    collisions.sort(key=lambda collision: (collision['a1'], collision['a2']))
     return collisions
 
 
@@ -78,18 +157,23 @@ def standard_splitting(collision):
     #                          specified timestep, and the second constraint prevents the second agent to traverse the
     #                          specified edge at the specified timestep
     # in this case, we can ignore final as all the paths are normalized
+    # the rectangle and corridor conflicts come with their own constraints
+    if 'constraints' in collision:
+        return collision['constraints']
     constraints = []
     if collision['type'] == 'vertex':
         constraints.append({
             'agent': collision['a1'],
             'loc': collision['loc'],
             'timestep': collision['timestep'],
+            'positive': False,
             'final': False
         })
         constraints.append({
             'agent': collision['a2'],
             'loc': collision['loc'],
             'timestep': collision['timestep'],
+            'positive': False,
             'final': False
         })
     elif collision['type'] == 'edge':
@@ -97,6 +181,7 @@ def standard_splitting(collision):
             'agent': collision['a1'],
             'loc': collision['loc'],
             'timestep': collision['timestep'],
+            'positive': False,
             'final': False
         })
         constraints.append({
@@ -104,12 +189,13 @@ def standard_splitting(collision):
             # revesred returns an iterator. In python list == iterator returns false, not an error: nasty bug
             'loc': list(reversed(collision['loc'])),
             'timestep': collision['timestep'],
+            'positive': False,
             'final': False
         })
     return constraints
 
 
-def disjoint_splitting(collision):
+def disjoint_splitting(collision, rng=random):
     ##############################
     # Task 4.1: Return a list of (two) constraints to resolve the given collision
     #           Vertex collision: the first constraint enforces one agent to be at the specified location at the
@@ -119,57 +205,324 @@ def disjoint_splitting(collision):
     #                          specified timestep, and the second constraint prevents the same agent to traverse the
     #                          specified edge at the specified timestep
     #           Choose the agent randomly
-
-    pass
+    if rng.randint(0, 1) == 0:
+        agent = collision['a1']
+        loc = collision['loc']
+    else:
+        agent = collision['a2']
+        # the edge of a collision is given in the direction of the first agent
+        loc = list(reversed(collision['loc']))
+    return [{'agent': agent,
+             'loc': loc,
+             'timestep': collision['timestep'],
+             'positive': True,
+             'final': False},
+            {'agent': agent,
+             'loc': loc,
+             'timestep': collision['timestep'],
+             'positive': False,
+             'final': False}]
 
 
 class CBSSolver(object):
     """The high-level search of CBS."""
 
-    def __init__(self, my_map, starts, goals):
+    def __init__(self, my_map, starts, goals, heuristic='lazy', cache_dir=HEURISTICS_CACHE_DIR,
+                 memory_budget=LAZY_MEMORY_BUDGET, num_landmarks=NUM_LANDMARKS, workers=1, seed=None,
+                 high_level_heuristic='none', bypass=True, target_reasoning=True,
+                 rectangle_reasoning=False, corridor_reasoning=False, merge_threshold=10,
+                 conflict_avoidance=True, station_load_penalty=STATION_LOAD_PENALTY,
+                 station_capacity=STATION_CAPACITY, station_throughput=STATION_THROUGHPUT):
         """my_map   - list of lists specifying obstacle positions
         starts      - [[(x1, y1), (x2, y2)], ...] list of start locations for each agent
         goals       - [[(x1, y1), (x2, y2)], ...] list of goal locations for each agent
+        heuristic   - how the heuristic tables are built, one of heuristics.HEURISTIC_MODES
+        cache_dir   - directory of the cached distance tables (None to disable the cache)
+        memory_budget - memory allowed for the per-goal tables of the lazy and landmark modes, in bytes
+        num_landmarks - number of landmarks of the landmark mode
+        workers     - processes computing the tables of the complete mode
+        seed        - seed of the random choices of the search (ties between collisions)
+        high_level_heuristic - h-values of the nodes, one of cbs_heuristic.HIGH_LEVEL_HEURISTICS
+        bypass      - adopt the paths of a child that costs the same as its parent with fewer collisions
+        target_reasoning - split the collisions with an agent waiting at its goal with length and target
+                      constraints, see find_target_conflict
+        rectangle_reasoning - split the rectangle conflicts with barrier constraints, see rectangle_reasoning
+        corridor_reasoning - split the corridor conflicts with range constraints, see corridor_reasoning
+        merge_threshold - conflicts between two meta-agents after which they are merged into one and planned
+                      together (MA-CBS), None to never merge them
+        conflict_avoidance - break the ties between the shortest paths of an agent on their collisions with
+                      the paths of the others (conflict-avoidance table), see plan_path
+        station_load_penalty - cost of a station to the agents assigned to it per other agent there,
+                      see choose_stations
+        station_capacity - agents that a station holds at a timestep, None for no limit, see schedule_stations
+        station_throughput - agents that enter a station in a timestep, None for no limit
         """
 
         self.start_time = 0
         self.my_map = my_map
+        self.graph = compile_map(my_map)
         self.starts = starts
         self.goals = goals
         self.num_of_agents = len(goals)
 
         self.num_of_generated = 0
         self.num_of_expanded = 0
+        self.num_of_bypasses = 0
+        self.num_of_merges = 0
         self.CPU_time = 0
 
         self.open_list = []
-        self.constraint_counts = {}
+        # conflicts between each pair of agents over the search, see should_merge
+        self.conflict_counts = {}
+        # meta-agents whose coupled search failed under their constraints
+        self.failed_merges = set()
+        self.rng = random.Random(seed)
 
-        starts = [self.starts[i][j] for i in range(self.num_of_agents) for j in range(len(self.starts[i]))]
-        goals = [self.goals[i][j] for i in range(self.num_of_agents) for j in range(len(self.goals[i]))]
         # Find inbound and outbound stations
-        self.inbound_stations = [(row, col) for row in range(len(my_map)) for col in range(len(my_map[0])) if my_map[row][col] == 'inbound']
-        self.outbound_stations = [(row, col) for row in range(len(my_map)) for col in range(len(my_map[0])) if my_map[row][col] == 'outbound']
-        # Compute heuristics for all possible goal locations
-        self.heuristics = {}
-        for goal in goals + starts + self.outbound_stations:
-            # if self.heuristics[goal] is None:
-            self.heuristics[goal] = compute_heuristics(my_map, goal)
+        self.inbound_stations = [loc for cell, loc in enumerate(self.graph['locs']) if self.graph['inbound'][cell]]
+        self.outbound_stations = [loc for cell, loc in enumerate(self.graph['locs']) if self.graph['outbound'][cell]]
+        # agents never have vertex collisions at the stations, whose capacity is checked instead
+        self.stations = set(self.inbound_stations + self.outbound_stations)
+        # Heuristics of the goal locations, computed when they are first needed in the lazy mode
+        self.heuristics = build_heuristics(self.graph, heuristic, cache_dir, memory_budget, num_landmarks, workers)
+        # MDDs of the agents, built when they are first needed
+        self.mdds = MDDCache(self.graph, self.heuristics)
+        self.bypass = bypass
+        self.cbs_heuristic = CBSHeuristic(self, high_level_heuristic)
+        self.target_reasoning = target_reasoning
+        self.rectangle_reasoning = RectangleReasoning(self) if rectangle_reasoning else None
+        self.corridor_reasoning = CorridorReasoning(self) if corridor_reasoning else None
+        self.merge_threshold = merge_threshold
+        self.conflict_avoidance = conflict_avoidance
+        self.station_load_penalty = station_load_penalty
+        # inbound and outbound station of each agent, see choose_stations
+        self.inbound_assignment = []
+        self.outbound_assignment = []
+        self.choose_stations()
+        self.station_capacity = station_capacity
+        self.station_throughput = station_throughput
+        # release slot of each agent from the queue of its inbound station, see schedule_stations
+        self.releases = []
+        self.release_constraints = []
+        self.schedule_stations([self.choose_waypoints(agent)[0] for agent in range(self.num_of_agents)])
+
+    def get_open_entry(self, node, id):
+        if self.cbs_heuristic.mode == 'none':
+            return len(node['collisions']), node['cost'], id, node
+        return node['cost'] + node['h'], len(node['collisions']), id, node
 
     def push_node(self, node):
-        heapq.heappush(self.open_list, (len(node['collisions']), node['cost'], self.num_of_generated, node))
+        heapq.heappush(self.open_list, self.get_open_entry(node, self.num_of_generated))
         if DEBUG:
             print("Generate node {}".format(self.num_of_generated))
         self.num_of_generated += 1
 
     def pop_node(self):
-        _, _, id, node = heapq.heappop(self.open_list)
-        if DEBUG:
-            print("Expand node {}".format(id))
-            self.num_of_expanded += 1
-        return node
-
-    def find_solution(self, disjoint=True):
+        """Return the next node of the open list, None if there is none left.
+        The informed h-value of a node is computed the first time the node is
+        popped: it goes back to the open list with it, or is pruned if it has
+        no solution (see CBSHeuristic.compute)."""
+        while self.open_list:
+            _, _, id, node = heapq.heappop(self.open_list)
+            if self.cbs_heuristic.informed and node['conflict_graph'] is None and node['collisions']:
+                h = self.cbs_heuristic.compute(node)
+                if h is not None:
+                    node['h'] = max(node['h'], h)
+                    heapq.heappush(self.open_list, self.get_open_entry(node, id))
+                continue
+            if DEBUG:
+                print("Expand node {}".format(id))
+                self.num_of_expanded += 1
+            return node
+        return None
+
+    def get_constraint_table(self, node, agent):
+        """Return the constraint table of agent at node. A node only stores its
+        own constraint and a link to its parent: the table is built from the
+        closest ancestor where it is cached, and cached at the nodes in between.
+        """
+        chain = []
+        while node is not None and agent not in node['tables']:
+            chain.append(node)
+            node = node['parent']
+        if node is None:
+            table = build_constraint_table(self.release_constraints[agent], agent, self.graph)
+        else:
+            table = node['tables'][agent]
+        for node in reversed(chain):
+            c = node['constraint']
+            if c is not None and (c['agent'] == agent or c.get('positive', False)):
+                # the tables of the ancestors are shared, so they are never modified
+                table = copy_constraint_table(table)
+                add_constraint(table, c, agent, self.graph)
+            node['tables'][agent] = table
+        return table
+
+    def get_paths(self, node):
+        """Return the paths of all the agents at node. A child node only stores
+        the paths of the agents it replanned, the list of the paths is
+        materialised when the node is expanded.
+        """
+        if node['paths'] is None:
+            paths = self.get_paths(node['parent']).copy()
+            for agent, path in node['replanned'].items():
+                paths[agent] = path
+            node['paths'] = paths
+        return node['paths']
+
+    def plan_path(self, agent, constraint_table, paths=None):
+        """Return the path of agent through the locations of choose_waypoints,
+        or None if there is none under its constraints. With conflict
+        avoidance, it is the shortest path that collides with the fewest of the
+        paths of the other agents (see a_star)."""
+        conflict_table = None
+        if self.conflict_avoidance and paths is not None:
+            conflict_table = build_conflict_table(self.graph, paths, agent, self.stations)
+        return a_star_waypoints(self.graph, self.choose_waypoints(agent), self.heuristics, agent, constraint_table,
+                                conflict_table)
+
+    def choose_stations(self):
+        """Assign each agent the inbound station its first start location is
+        the closest to, and the outbound station closest to its last goal
+        location, with a penalty per other agent at the same station (see
+        station_assignment.assign_stations), so that the agents do not all
+        crowd the nearest one. The stations stay the same over the search."""
+        if len(self.inbound_stations) > 0:
+            costs = [[self.heuristics.distance(station, self.starts[agent][0]) for station in self.inbound_stations]
+                     for agent in range(self.num_of_agents)]
+            self.inbound_assignment = [self.inbound_stations[station]
+                                       for station in assign_stations(costs, self.station_load_penalty)]
+        if len(self.outbound_stations) > 0:
+            costs = [[self.heuristics.distance(self.goals[agent][-1], station) for station in self.outbound_stations]
+                     for agent in range(self.num_of_agents)]
+            self.outbound_assignment = [self.outbound_stations[station]
+                                        for station in assign_stations(costs, self.station_load_penalty)]
+
+    def schedule_stations(self, starts):
+        """Give each agent that starts at a station a release slot, when it
+        enters the station from the queue upstream of it (see
+        station_schedule.schedule_releases), and the constraints that keep it
+        there until then, at the root of the constraint tables."""
+        self.releases = schedule_releases(starts, self.stations, self.station_capacity, self.station_throughput)
+        self.release_constraints = [get_release_constraints(agent, loc, release)
+                                    for agent, (loc, release) in enumerate(zip(starts, self.releases))]
+
+    def update_station_conflicts(self, collisions, paths):
+        """Return the collisions between the agents of paths followed by their
+        station conflicts, the stations that hold or take in more agents at a
+        timestep than their capacity or throughput (see
+        station_schedule.detect_station_conflicts)."""
+        collisions = [collision for collision in collisions if collision['type'] != 'station']
+        return collisions + detect_station_conflicts(paths, self.releases, self.stations,
+                                                     self.station_capacity, self.station_throughput)
+
+    def choose_waypoints(self, agent):
+        """Return the locations that the path of agent goes through: all its
+        start and goal locations, from its inbound station to its outbound
+        station (see choose_stations)."""
+        waypoints = [loc for j in range(len(self.starts[agent])) for loc in (self.starts[agent][j], self.goals[agent][j])]
+        if len(self.inbound_stations) > 0:
+            waypoints.insert(0, self.inbound_assignment[agent])
+        if len(self.outbound_stations) > 0:
+            waypoints.append(self.outbound_assignment[agent])
+        return waypoints
+
+    def get_waypoints(self, agent, path):
+        """Return the locations that the path of agent goes through one leg
+        after the other, see plan_path."""
+        waypoints = [loc for j in range(len(self.starts[agent])) for loc in (self.starts[agent][j], self.goals[agent][j])]
+        if len(self.inbound_stations) > 0:
+            waypoints.insert(0, path[0])
+        if len(self.outbound_stations) > 0:
+            waypoints.append(path[-1])
+        return waypoints
+
+    def get_mdd(self, node, agent):
+        """Return the MDD of the shortest paths of agent under its constraints
+        at node (see mdd.build_path_mdd), from the cache when the agent had the
+        same constraints at another node."""
+        if len(node['meta_agents'][agent]) > 1:
+            return None  # the paths of a meta-agent are not the shortest ones of its agents
+        path = self.get_paths(node)[agent]
+        return self.mdds.get(agent, self.get_waypoints(agent, path), self.get_constraint_table(node, agent),
+                             len(path) - 1)
+
+    def classify_collisions(self, node):
+        """Return the pairs (collision, type) of the collisions of node, see
+        classify_collision. The station conflicts are non-cardinal."""
+        return [(collision, NON_CARDINAL if collision['type'] == 'station' else
+                 classify_collision(collision, self.get_mdd(node, collision['a1']),
+                                    self.get_mdd(node, collision['a2']), self.graph))
+                for collision in node['collisions']]
+
+    def choose_collision(self, node):
+        """Return the collision of node to split: a cardinal one if there is
+        any, else a semi-cardinal one, else any (see classify_collision). A
+        collision that belongs to a target, a corridor or a rectangle conflict
+        is replaced by it, and these conflicts come first, in this order, among
+        the collisions of the same type. The ties are broken at random."""
+        best_key = None
+        best = []
+        for collision, collision_type in self.classify_collisions(node):
+            conflict = None
+            if self.target_reasoning:
+                conflict = self.find_target_conflict(node, collision)
+                order = 0
+            if conflict is None and self.corridor_reasoning is not None:
+                conflict = self.corridor_reasoning.run(node, collision)
+                order = 1
+            if conflict is None and self.rectangle_reasoning is not None:
+                rectangle = self.rectangle_reasoning.run(node, collision, collision_type)
+                if rectangle is not None:
+                    conflict, collision_type = rectangle
+                    order = 2
+            if conflict is None:
+                order = 3
+            else:
+                collision = conflict
+            key = (collision_type, order)
+            if best_key is None or key < best_key:
+                best_key = key
+                best = [collision]
+            elif key == best_key:
+                best.append(collision)
+        return self.rng.choice(best)
+
+    def find_target_conflict(self, node, collision):
+        """Return the target conflict of the collision of node, or None: one of
+        the agents is waiting at its goal, where the other one arrives. Either
+        the path of the first agent is longer than the timestep of the
+        collision, or the goal stays free of the other agent from then on,
+        rather than only at this timestep."""
+        if collision['type'] != 'vertex':
+            return None
+        paths = self.get_paths(node)
+        loc = collision['loc'][0]
+        timestep = collision['timestep']
+        for agent, other in [(collision['a1'], collision['a2']), (collision['a2'], collision['a1'])]:
+            path = paths[agent]
+            if path[-1] != loc or timestep < len(path) - 1:
+                continue
+            return {'a1': collision['a1'],
+                    'a2': collision['a2'],
+                    'loc': collision['loc'],
+                    'timestep': timestep,
+                    'type': 'target',
+                    'constraints': [{'agent': agent,
+                                     'loc': [loc],
+                                     'timestep': timestep,
+                                     'positive': False,
+                                     'final': False,
+                                     'type': 'length'},
+                                    {'agent': other,
+                                     'loc': [loc],
+                                     'timestep': timestep,
+                                     'positive': False,
+                                     'final': False,
+                                     'type': 'target'}]}
+        return None
+
+    def find_solution(self, disjoint=False):
         """ Finds paths for all agents from their start locations to their goal locations
 
         disjoint    - use disjoint splitting or not
@@ -178,50 +531,33 @@ class CBSSolver(object):
         self.start_time = timer.time()
 
         # Generate the root node
-        # constraints   - list of constraints
         # paths         - list of paths, one for each agent
         #               [[(x11, y11), (x12, y12), ...], [(x21, y21), (x22, y22), ...], ...]
         # collisions     - list of collisions in paths
+        # constraint    - constraint added by the node, None at the root
+        # parent        - parent node, None at the root
+        # replanned     - new paths of the agents replanned by the node
+        # tables        - constraint tables of the agents, see get_constraint_table
+        # h             - h-value, see cbs_heuristic
+        # conflict_graph - edges of the graph the h-value is computed from, None until it is
+        # meta_agents   - the agents of the meta-agent of each agent, planned together
         root = {'cost': 0,
-                'constraints': [],
+                'constraint': None,
+                'parent': None,
+                'replanned': {},
                 'paths': [],
-                'collisions': []}
+                'collisions': [],
+                'tables': {},
+                'h': 0,
+                'conflict_graph': None,
+                'meta_agents': [(i,) for i in range(self.num_of_agents)]}
         
         # Find initial path for each agent from start to goal
-        for i in range(self.num_of_agents):
-            final_path = []
-            if len(self.inbound_stations) == 0:
-                path_to_start = []
-            else:
-                inbound = random.choice(self.inbound_stations)
-                path_to_start = a_star(self.my_map, inbound, self.starts[i][0], self.heuristics[self.starts[i][0]], i, root['constraints'])
-                final_path += path_to_start
-            if path_to_start is None:
-                raise BaseException('No solutions')
-            
-            for j in range(len(self.starts[i])):
-                path = a_star(self.my_map, self.starts[i][j], self.goals[i][j], self.heuristics[self.goals[i][j]], i, root['constraints'])
-                if path is None:
-                    raise BaseException('No solutions')
-                final_path += path
-                if j+1 < len(self.starts[i]):
-                    path_to_next = a_star(self.my_map, self.goals[i][j], self.starts[i][j+1], self.heuristics[self.starts[i][j+1]], i, root['constraints'])
-                    if path_to_next is None:
-                        raise BaseException('No solutions')
-                    final_path += path_to_next
-
-            if len(self.outbound_stations) == 0:
-                outbound_path = []
-            else:
-                outbound = random.choice(self.outbound_stations)
-                outbound_path = a_star(self.my_map, self.goals[i][-1], outbound, self.heuristics[outbound], i, root['constraints'])
-            if outbound_path is None:
-                raise BaseException('No solutions')
-            final_path += outbound_path
-            root['paths'].append(final_path)
+        self.plan_root(root)
 
         root['cost'] = get_sum_of_cost(root['paths'])
-        root['collisions'] = detect_collisions(root['paths'], self.inbound_stations, self.outbound_stations)
+        root['collisions'] = self.update_station_conflicts(detect_collisions(root['paths'], self.stations),
+                                                           root['paths'])
         self.push_node(root)
 
         # Task 3.1: Testing
@@ -244,56 +580,201 @@ class CBSSolver(object):
 
         while self.open_list:
             p = self.pop_node()
-            # if there are no collisions, we found a solution
-            if not p['collisions']:
-                self.print_results(p)
-                return p['paths']
-            collision = random.choice(p['collisions'])
-            constraints = standard_splitting(collision)
-            for c in constraints:
-                constraint_key = (c['agent'], tuple(c['loc']), c['timestep'])
-                if constraint_key in self.constraint_counts:
-                    self.constraint_counts[constraint_key] += 1
-                else:
-                    self.constraint_counts[constraint_key] = 1
-
-                if self.constraint_counts[constraint_key] >= 3:
-                    continue
-                q = {'cost': 0,
-                     'constraints': p['constraints'] + [c],
-                     'paths': p['paths'].copy(),
-                     'collisions': []}
-                agent = c['agent']
-                final_path = []
-                if len(self.inbound_stations) == 0:
-                    path_to_start = []
-                else:
-                    inbound = random.choice(self.inbound_stations)
-                    path_to_start = a_star(self.my_map, inbound, self.starts[agent][0], self.heuristics[self.starts[agent][0]], agent, q['constraints'])
-                final_path += path_to_start
-                for j in range(len(self.starts[agent])):
-                    path = a_star(self.my_map, self.starts[agent][j], self.goals[agent][j], self.heuristics[self.goals[agent][j]], agent, q['constraints'])
-                    final_path += path
-                    if j+1 < len(self.starts[agent]):
-                        path_to_next = a_star(self.my_map, self.goals[agent][j], self.starts[agent][j+1], self.heuristics[self.starts[agent][j+1]], agent, root['constraints'])
-                        if path_to_next is None:
-                            raise BaseException('No solutions')
-                        final_path += path_to_next
-                if len(self.outbound_stations) == 0:
-                    outbound_path = []
-                else:
-                    outbound = random.choice(self.outbound_stations)
-                    outbound_path = a_star(self.my_map, self.goals[agent][-1], outbound, self.heuristics[outbound], agent, q['constraints'])
-                final_path += outbound_path
-                if path:
-                    q['paths'][agent] = final_path
-                    q['collisions'] = detect_collisions(q['paths'], self.inbound_stations, self.outbound_stations)
-                    q['cost'] = get_sum_of_cost(q['paths'])
-                    print(q['collisions'])
-                    self.push_node(q)
+            if p is None:
+                break
+            # p is split again as long as it adopts the paths of one of its children
+            adopted = True
+            while adopted:
+                p_paths = self.get_paths(p)
+                # if there are no collisions, we found a solution
+                if not p['collisions']:
+                    self.print_results(p)
+                    return p_paths
+                children = self.generate_children(p, p_paths, disjoint)
+                adopted = children is None
+                if not adopted:
+                    for q in children:
+                        print(q['collisions'])
+                        self.push_node(q)
     
         return None  # No solution found
 
+    def plan_root(self, root):
+        """Plan the path of each agent at the root, without constraints."""
+        for i in range(self.num_of_agents):
+            final_path = self.plan_path(i, self.get_constraint_table(root, i), root['paths'])
+            if final_path is None:
+                raise BaseException('No solutions')
+            root['paths'].append(final_path)
+
+    def generate_children(self, p, p_paths, disjoint):
+        """Split p on one of its collisions and return its children, or None if
+        p adopted the paths of one of them instead (see adopt_bypass). If the
+        meta-agents of the collision conflicted too often, p has a single child
+        where they are merged instead (see merge)."""
+        collision = self.choose_collision(p)
+        if self.should_merge(p, collision):
+            q = self.merge(p, p_paths, collision)
+            if q is not None:
+                return [q]
+        if disjoint and 'constraints' not in collision:
+            constraints = disjoint_splitting(collision, self.rng)
+        else:
+            constraints = standard_splitting(collision)
+        children = []
+        for i, c in enumerate(constraints):
+            q = self.new_child(p, c, p['meta_agents'])
+            # the agent of the constraint is replanned, and with a positive
+            # constraint so are the agents that collide with it
+            agents = [c['agent']]
+            if c['positive']:
+                agents += paths_violate_constraint(c, p_paths)
+            if self.replan(q, p, p_paths, agents):
+                if self.is_bypass(p, q, len(children) == i):
+                    self.adopt_bypass(p, q)
+                    return None
+                # the cost of the descendants of p is at least its f-value (pathmax)
+                q['h'] = max(0, p['cost'] + p['h'] - q['cost'])
+                children.append(q)
+        return children
+
+    @staticmethod
+    def new_child(p, constraint, meta_agents):
+        return {'cost': 0,
+                'constraint': constraint,
+                'parent': p,
+                'replanned': {},
+                'paths': None,
+                'collisions': [],
+                'tables': {},
+                'h': 0,
+                'conflict_graph': None,
+                'meta_agents': meta_agents}
+
+    def should_merge(self, p, collision):
+        """Count the collision between its two agents, and return True if their
+        meta-agents at p conflicted more than merge_threshold times over the
+        search, as in MA-CBS. The meta-agents are planned regardless of the
+        capacity of the stations, so they are not merged on a station conflict."""
+        if self.merge_threshold is None or collision['type'] == 'station':
+            return False
+        pair = (collision['a1'], collision['a2'])
+        self.conflict_counts[pair] = self.conflict_counts.get(pair, 0) + 1
+        meta_agent1 = p['meta_agents'][collision['a1']]
+        meta_agent2 = p['meta_agents'][collision['a2']]
+        conflicts = sum(self.conflict_counts.get((min(a1, a2), max(a1, a2)), 0)
+                        for a1 in meta_agent1 for a2 in meta_agent2)
+        return conflicts > self.merge_threshold
+
+    def merge(self, p, p_paths, collision):
+        """Return the child of p where the meta-agents of the two agents of the
+        collision are merged into one, planned together under the constraints
+        of p (see replan). None if their coupled search fails."""
+        meta_agent = tuple(sorted(p['meta_agents'][collision['a1']] + p['meta_agents'][collision['a2']]))
+        meta_agents = list(p['meta_agents'])
+        for agent in meta_agent:
+            meta_agents[agent] = meta_agent
+        q = self.new_child(p, None, meta_agents)
+        key = tuple((agent, self.get_constraint_table(q, agent)['constraints']) for agent in meta_agent)
+        if key in self.failed_merges or not self.replan(q, p, p_paths, meta_agent, META_AGENT_NODE_LIMIT):
+            self.failed_merges.add(key)
+            return None
+        q['h'] = max(0, p['cost'] + p['h'] - q['cost'])
+        self.num_of_merges += 1
+        return q
+
+    def is_bypass(self, p, q, siblings_solved):
+        """Return True if p adopts the paths of its child q (see adopt_bypass):
+        q costs the same as p with fewer collisions. A child is only adopted if
+        its siblings before it have a path too, as in CBSH2-RTC."""
+        return self.bypass and siblings_solved and q['cost'] == p['cost'] \
+            and len(q['collisions']) < len(p['collisions'])
+
+    def adopt_bypass(self, p, q):
+        """Give p the paths that its child q replanned (bypass): p is split
+        again on the collisions of q rather than generating its children. The
+        paths of q satisfy the constraints of p, which are unchanged."""
+        paths = self.get_paths(p).copy()
+        for agent, path in q['replanned'].items():
+            paths[agent] = path
+        p['paths'] = paths
+        p['collisions'] = q['collisions']
+        if p['conflict_graph'] is not None:
+            # the children of p only inherit the edges of the agents they do not replan
+            p['conflict_graph'] = {(a1, a2): w for (a1, a2), w in p['conflict_graph'].items()
+                                   if a1 not in q['replanned'] and a2 not in q['replanned']}
+        self.num_of_bypasses += 1
+
+    def replan(self, q, p, p_paths, agents, node_limit=None):
+        """Replan the agents at the child q of p, and update the cost and the
+        collisions of q. The agents of a meta-agent are planned together, by a
+        coupled search through the waypoints of their paths at p (see
+        meta_agent_planner), given up after node_limit expansions. Return False
+        if one of the agents has no path."""
+        q['cost'] = p['cost']
+        q['collisions'] = p['collisions']
+        meta_agents = []
+        for agent in agents:
+            if q['meta_agents'][agent] not in meta_agents:
+                meta_agents.append(q['meta_agents'][agent])
+        paths = p_paths
+        for meta_agent in meta_agents:
+            if len(meta_agent) == 1:
+                new_paths = [self.plan_path(meta_agent[0], self.get_constraint_table(q, meta_agent[0]), paths)]
+            else:
+                new_paths = plan_meta_agent(self.graph, [self.get_waypoints(agent, p_paths[agent]) for agent in meta_agent],
+                                            self.heuristics,
+                                            [self.get_constraint_table(q, agent) for agent in meta_agent],
+                                            self.stations, node_limit)
+                if new_paths is None:
+                    return False
+            for agent, path in zip(meta_agent, new_paths):
+                if path is None:
+                    return False
+                q['replanned'][agent] = path
+                q['collisions'] = update_collisions(q['collisions'], paths, agent, path, self.stations)
+                q['cost'] += len(path) - len(paths[agent])
+                paths = paths.copy()
+                paths[agent] = path
+        q['collisions'] = self.update_station_conflicts(q['collisions'], paths)
+        return True
+
+    def solve_two_agents(self, node, a1, a2, node_limit):
+        """Return the cost that a1 and a2 add to their paths at node to avoid
+        each other, from a CBS search on these two agents alone under their
+        constraints at node. None if they have no solution. After node_limit
+        expansions, return the lowest cost left in the open list instead, a
+        lower bound."""
+        paths = self.get_paths(node)
+        agents = [a1, a2]
+        waypoints = [self.get_waypoints(agent, paths[agent]) for agent in agents]
+        # the nodes are (paths, constraint tables) of the two agents
+        root_cost = get_sum_of_cost([paths[a1], paths[a2]])
+        open_list = [(root_cost, 0, [paths[a1], paths[a2]],
+                      [self.get_constraint_table(node, agent) for agent in agents])]
+        num_generated = 1
+        num_expanded = 0
+        while open_list:
+            cost, _, sub_paths, tables = heapq.heappop(open_list)
+            collisions = detect_collisions(sub_paths, self.stations)
+            if not collisions or num_expanded == node_limit:
+                return cost - root_cost
+            num_expanded += 1
+            for c in standard_splitting(collisions[0]):
+                i = c['agent']
+                table = copy_constraint_table(tables[i])
+                add_constraint(table, c, i, self.graph)
+                path = a_star_waypoints(self.graph, waypoints[i], self.heuristics, agents[i], table)
+                if path is None:
+                    continue
+                child_paths = sub_paths.copy()
+                child_paths[i] = path
+                child_tables = tables.copy()
+                child_tables[i] = table
+                heapq.heappush(open_list, (get_sum_of_cost(child_paths), num_generated, child_paths, child_tables))
+                num_generated += 1
+        return None
+
     def print_results(self, node):
         print("\n Found a solution! \n")
         CPU_time = timer.time() - self.start_time
@@ -301,3 +782,21 @@ class CBSSolver(object):
         print("Sum of costs:    {}".format(get_sum_of_cost(node['paths'])))
         print("Expanded nodes:  {}".format(self.num_of_expanded))
         print("Generated nodes: {}".format(self.num_of_generated))
+        print("Adopted bypasses: {}".format(self.num_of_bypasses))
+        if self.merge_threshold is not None:
+            print("Merged meta-agents: {}".format(self.num_of_merges))
+        if self.cbs_heuristic.informed:
+            print("Merged MDDs:     {}".format(self.cbs_heuristic.num_merge_mdds))
+            print("2-agent searches: {}".format(self.cbs_heuristic.num_solve_2agent_problems))
+            print("Memoized pairs:  {}".format(self.cbs_heuristic.num_memoization))
+            print("Heuristic graph time (s): {:.2f}".format(self.cbs_heuristic.runtime_build_dependency_graph))
+            print("MVC time (s):    {:.2f}".format(self.cbs_heuristic.runtime_solve_mvc))
+        if self.rectangle_reasoning is not None:
+            print("Rectangle conflicts: {}".format(self.rectangle_reasoning.num_rectangles))
+            print("Rectangle time (s): {:.2f}".format(self.rectangle_reasoning.runtime))
+        if self.corridor_reasoning is not None:
+            print("Corridor conflicts: {}".format(self.corridor_reasoning.num_corridors))
+            print("Corridor time (s): {:.2f}".format(self.corridor_reasoning.runtime))
+        for loc, (entries, peak, throughput) in get_station_statistics(node['paths'], self.releases,
+                                                                       self.stations).items():
+            print("Station {}: {} agents, peak {}, {:.3f} per timestep".format(loc, entries, peak, throughput))
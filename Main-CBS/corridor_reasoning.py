@@ -0,0 +1,143 @@
+import time as timer
+from single_agent_planner import get_cell, get_location, get_travel_time
+
+
+class CorridorReasoning(object):
+    """Corridor reasoning of CBSH2-RTC (C): two agents that cross a corridor
+    (a chain of cells of degree 2) in opposite directions collide on every pair
+    of paths until one of them waits for the other to get out, or goes around,
+    and standard splitting resolves them one timestep at a time. A corridor
+    conflict is split instead with two range constraints, each keeping one of
+    the agents out of the end of the corridor it leaves by until the earliest
+    time it can get there without colliding (see add_constraint)."""
+
+    def __init__(self, solver, wait_at_goal=True):
+        """solver           - CBSSolver whose collisions are examined
+        wait_at_goal        - agents stay at their goal after the end of their path,
+                              otherwise their goal cannot be at an end of the corridor
+        """
+        self.solver = solver
+        self.graph = solver.graph
+        self.wait_at_goal = wait_at_goal
+        self.num_corridors = 0
+        self.runtime = 0
+
+    def get_degree(self, loc):
+        # the first neighbor of a cell is the cell itself (a wait)
+        cell = get_cell(self.graph, loc)
+        return self.graph['offsets'][cell + 1] - self.graph['offsets'][cell] - 1
+
+    def run(self, node, collision):
+        """Return the corridor conflict that the collision of node belongs to, or
+        None. The conflict is a collision of type 'corridor' whose 'constraints'
+        split it."""
+        start_time = timer.time()
+        corridor = self.find_corridor_conflict(node, collision)
+        self.runtime += timer.time() - start_time
+        if corridor is not None:
+            self.num_corridors += 1
+        return corridor
+
+    def find_corridor_conflict(self, node, collision):
+        if collision['type'] == 'station':
+            return None
+        agents = [collision['a1'], collision['a2']]
+        timestep = collision['timestep']
+        if self.get_degree(collision['loc'][0]) == 2:
+            if len(collision['loc']) == 2:
+                timestep -= 1  # the first agent is at the first cell of the edge before
+        elif len(collision['loc']) != 2 or self.get_degree(collision['loc'][1]) != 2:
+            return None
+        paths = self.solver.get_paths(node)
+        # the times the agents enter the corridor, the first one first
+        enter_times = [self.get_entering_time(paths[agents[0]], paths[agents[1]], timestep),
+                       self.get_entering_time(paths[agents[1]], paths[agents[0]], timestep)]
+        if enter_times[0] > enter_times[1]:
+            enter_times.reverse()
+            agents.reverse()
+        paths = [paths[agent] for agent in agents]
+        enter_locs = [get_location(path, t) for path, t in zip(paths, enter_times)]
+        if enter_locs[0] == enter_locs[1]:
+            return None
+        # each agent leaves the corridor by the end the other one enters it by
+        for i in range(2):
+            if enter_locs[1 - i] not in paths[i][enter_times[i]:]:
+                return None
+        if not self.wait_at_goal and (paths[0][-1] in enter_locs or paths[1][-1] in enter_locs):
+            return None  # the agent leaves the map at the end of the corridor
+        length, edge = self.get_corridor_length(paths[0], enter_times[0], enter_locs[1])
+        if length < 2:
+            return None
+        # blocking the corridor both ways, the agents have to go around it
+        cells = [get_cell(self.graph, loc) for loc in edge]
+        blocked_edges = {(cells[0], cells[1]), (cells[1], cells[0])}
+        tables = [self.solver.get_constraint_table(node, agent) for agent in agents]
+        t3 = get_travel_time(self.graph, paths[0][0], enter_locs[1], tables[0])
+        t4 = get_travel_time(self.graph, paths[1][0], enter_locs[0], tables[1])
+        if t3 is None or t4 is None or abs(t3 - t4) > length:
+            return None
+        t3_ = get_travel_time(self.graph, paths[0][0], enter_locs[1], tables[0], t3 + 2 * length + 1, blocked_edges)
+        t4_ = get_travel_time(self.graph, paths[1][0], enter_locs[0], tables[1], t4 + 2 * length + 1, blocked_edges)
+        if t3_ <= t3 or t4_ <= t4:
+            return None
+        # the first agent either goes around the corridor or waits for the
+        # other one to cross it, and the other way round
+        t1 = min(t3_ - 1, t4 + length)
+        t2 = min(t4_ - 1, t3 + length)
+        constraints = [{'agent': agents[0],
+                        'loc': [enter_locs[1]],
+                        'timestep': t1,
+                        'positive': False,
+                        'final': False,
+                        'type': 'range'},
+                       {'agent': agents[1],
+                        'loc': [enter_locs[0]],
+                        'timestep': t2,
+                        'positive': False,
+                        'final': False,
+                        'type': 'range'}]
+        for path, c in zip(paths, constraints):
+            if not any(get_location(path, t) == c['loc'][0] for t in range(c['timestep'] + 1)):
+                return None
+        return {'a1': collision['a1'],
+                'a2': collision['a2'],
+                'loc': collision['loc'],
+                'timestep': collision['timestep'],
+                'type': 'corridor',
+                'constraints': constraints}
+
+    def get_entering_time(self, path, other_path, timestep):
+        """Return the time at which path enters the corridor it is in at
+        timestep: the last time before it at a cell of another degree, or at
+        the start of path or the goal of other_path."""
+        t = min(timestep, len(path) - 1)
+        while path[t] != path[0] and path[t] != other_path[-1] and self.get_degree(path[t]) == 2:
+            t -= 1
+        return t
+
+    @staticmethod
+    def get_corridor_length(path, enter_time, exit_loc):
+        """Return the length of the corridor that path crosses from enter_time
+        to exit_loc, and its first edge in the direction of path."""
+        curr = path[enter_time]
+        prev = None
+        length = 0
+        edge = None
+        forward = True
+        t = enter_time
+        while curr != exit_loc:
+            t += 1
+            next_loc = path[t]
+            if next_loc == curr:
+                continue  # a wait
+            if next_loc == prev:
+                forward = not forward  # a turn around
+            if forward:
+                if edge is None:
+                    edge = (curr, next_loc)
+                length += 1
+            else:
+                length -= 1
+            prev = curr
+            curr = next_loc
+        return length, edge
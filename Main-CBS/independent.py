@@ -1,5 +1,5 @@
 import time as timer
-from single_agent_planner import compute_heuristics, a_star, get_sum_of_cost
+from single_agent_planner import compile_map, compute_heuristics, a_star, build_constraint_table, get_sum_of_cost
 
 
 class IndependentSolver(object):
@@ -12,6 +12,7 @@ class IndependentSolver(object):
         """
 
         self.my_map = my_map
+        self.graph = compile_map(my_map)
         self.starts = starts
         self.goals = goals
         self.num_of_agents = len(goals)
@@ -21,7 +22,7 @@ class IndependentSolver(object):
         # compute heuristics for the low-level search
         self.heuristics = []
         for goal in self.goals:
-            self.heuristics.append(compute_heuristics(my_map, goal))
+            self.heuristics.append(compute_heuristics(self.graph, goal))
 
     def find_solution(self):
         """ Finds paths for all agents from their start locations to their goal locations."""
@@ -33,8 +34,8 @@ class IndependentSolver(object):
         # Task 0: Understand the following code (see the lab description for some hints)
 
         for i in range(self.num_of_agents):  # Find path for each agent
-            path = a_star(self.my_map, self.starts[i], self.goals[i], self.heuristics[i],
-                          i, [])
+            path = a_star(self.graph, self.starts[i], self.goals[i], self.heuristics[i],
+                          i, build_constraint_table([], i, self.graph))
             if path is None:
                 raise BaseException('No solutions')
             result.append(path)
@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from single_agent_planner import get_cell, get_leg_heuristics, is_constrained, is_goal_constrained
+
+# MDDs kept by an MDDCache, the least recently used are evicted above this number
+MAX_MDDS = 10000
+
+# types of the collisions, see classify_collision, in the order they are split
+CARDINAL = 0
+SEMI_CARDINAL = 1
+NON_CARDINAL = 2
+
+
+def build_path_mdd(graph, waypoints, heuristics, constraint_table, max_cost):
+    """Return the multi-valued decision diagram (MDD) of the shortest paths that
+    go through the waypoints one after the other under the constraints, as
+    planned by a_star_waypoints: mdd[t] maps each cell that one of these paths
+    is at at time t to the cells they move to at time t + 1. The last level is
+    {goal: []}. Return None if the shortest paths cost more than max_cost (or
+    there is no path).
+
+    The MDD is built over the (cell, leg) states of a_star_waypoints, then each
+    level is reduced to its cells: two paths at a cell at the same time on
+    different legs share its node."""
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    cells, rest = get_leg_heuristics(graph, waypoints, heuristics)
+    h_tables = [None] + [heuristics[loc] for loc in waypoints[1:]]
+    last_leg = len(waypoints) - 1
+    goal = (cells[-1], last_leg)
+    # forward: the states reachable at each time, from which the goal can
+    # still be reached within max_cost according to the (admissible)
+    # heuristics, until the goal is reached at a time it is not constrained
+    # after, as in a_star_waypoints
+    levels = [{(cells[0], 1): []}]
+    cost = 0
+    while goal not in levels[cost] or is_goal_constrained(goal[0], cost, constraint_table):
+        if cost >= max_cost:
+            return None
+        child_time = cost + 1
+        level = dict()
+        for (cell, leg), children in levels[cost].items():
+            moves = [(child_cell, leg) for child_cell in neighbors[offsets[cell]:offsets[cell + 1]]]
+            if leg < last_leg and cell == cells[leg]:
+                moves.append((cell, leg + 1))  # the next leg starts after a timestep at the waypoint
+            for child in moves:
+                child_cell, child_leg = child
+                if child_time + h_tables[child_leg][child_cell] + rest[child_leg] > max_cost:
+                    continue
+                if is_constrained(cell, child_cell, child_time, constraint_table):
+                    continue
+                children.append(child)
+                if child not in level:
+                    level[child] = []
+        if len(level) == 0:
+            return None
+        levels.append(level)
+        cost = child_time
+    # backward: keep the states that reach the goal at time cost, and merge
+    # the states of each level by cell
+    mdd = [{goal[0]: []}]
+    next_level = {goal}
+    for time in range(cost - 1, -1, -1):
+        level = set()
+        cell_level = dict()
+        for state, children in levels[time].items():
+            children = [child for child in children if child in next_level]
+            if children:
+                level.add(state)
+                cell_children = cell_level.setdefault(state[0], [])
+                for child_cell, _ in children:
+                    if child_cell not in cell_children:
+                        cell_children.append(child_cell)
+        mdd.append(cell_level)
+        next_level = level
+    mdd.reverse()
+    return mdd
+
+
+def get_mdd_level(mdd, timestep):
+    """Return the cells of the MDD at timestep. The agent waits at its last
+    location once its path is over (see get_location)."""
+    if timestep < len(mdd):
+        return mdd[timestep]
+    return mdd[-1]
+
+
+def get_mdd_children(mdd, timestep, cell):
+    """Return the cells that the paths of the MDD at cell at timestep move to."""
+    if timestep < len(mdd) - 1:
+        return mdd[timestep][cell]
+    return [cell]
+
+
+def joint_mdd_exists(mdd1, mdd2, stations=frozenset(), wait_at_goal=True):
+    """Return True if one of the paths of mdd1 and one of the paths of mdd2 do
+    not collide, that is if the two agents can keep their costs together.
+    stations        - cells where the agents never have vertex collisions
+    wait_at_goal    - the agent that arrives first stays at its goal until the
+                      end of the other path, otherwise the paths are only
+                      compared up to the end of the shorter one
+    """
+    end = max(len(mdd1), len(mdd2)) if wait_at_goal else min(len(mdd1), len(mdd2))
+    # depth-first search over the pairs of cells that the two agents can be at
+    # together at each time: most pairs of agents are independent, and the
+    # search stops at the first pair of paths that do not collide
+    open_list = [(0, cell1, cell2) for cell1 in mdd1[0] for cell2 in mdd2[0] if cell1 != cell2 or cell1 in stations]
+    closed_list = set(open_list)
+    while open_list:
+        time, cell1, cell2 = open_list.pop()
+        if time == end - 1:
+            return True
+        for child1 in get_mdd_children(mdd1, time, cell1):
+            for child2 in get_mdd_children(mdd2, time, cell2):
+                if child1 == child2:
+                    if child1 not in stations:
+                        continue  # vertex collision
+                elif child1 == cell2 and child2 == cell1:
+                    continue  # edge collision
+                child = (time + 1, child1, child2)
+                if child not in closed_list:
+                    closed_list.add(child)
+                    open_list.append(child)
+    return False
+
+
+def is_singleton(mdd, cells, timestep):
+    """Return True if every path of the MDD goes through the vertex cells[0] at
+    timestep, or through the edge cells[0] -> cells[1] at timestep (from
+    timestep - 1): the agent cannot avoid the collision without a longer path."""
+    if mdd is None:
+        return False
+    for cell, time in zip(reversed(cells), range(timestep, -1, -1)):
+        level = get_mdd_level(mdd, time)
+        if len(level) != 1 or cell not in level:
+            return False
+    return True
+
+
+def classify_collision(collision, mdd1, mdd2, graph):
+    """Return the type of the collision, from the MDDs of its agents: CARDINAL
+    if neither agent can avoid it without a longer path, so that both children
+    of the split cost more, SEMI_CARDINAL if one of them cannot, NON_CARDINAL
+    otherwise."""
+    # the edge of a collision is given in the direction of the first agent
+    cells = [get_cell(graph, loc) for loc in collision['loc']]
+    singletons = is_singleton(mdd1, cells, collision['timestep']) \
+        + is_singleton(mdd2, list(reversed(cells)), collision['timestep'])
+    return [NON_CARDINAL, SEMI_CARDINAL, CARDINAL][singletons]
+
+
+class MDDCache(object):
+    """MDDs of the agents, keyed by the agent, its waypoints and the constraints
+    of its constraint table: the nodes of the CBS tree that share these share
+    the MDD, whichever order the constraints were added in. The least recently
+    used MDDs are evicted above max_mdds."""
+
+    def __init__(self, graph, heuristics, max_mdds=MAX_MDDS):
+        """graph            - compiled map, as returned by compile_map
+        heuristics          - heuristic provider, see heuristics.build_heuristics
+        max_mdds            - number of MDDs kept in the cache
+        """
+        self.graph = graph
+        self.heuristics = heuristics
+        self.max_mdds = max_mdds
+        self.mdds = OrderedDict()
+        self.num_built = 0
+        self.num_hits = 0
+        self.num_evicted = 0
+
+    def get(self, agent, waypoints, constraint_table, cost):
+        """Return the MDD of agent through the waypoints, see build_path_mdd."""
+        key = (agent, tuple(waypoints), constraint_table['constraints'])
+        if key in self.mdds:
+            self.mdds.move_to_end(key)
+            self.num_hits += 1
+            return self.mdds[key]
+        mdd = build_path_mdd(self.graph, waypoints, self.heuristics, constraint_table, cost)
+        self.num_built += 1
+        if mdd is None:
+            return None  # not cached: the cost may be too low for these constraints
+        self.mdds[key] = mdd
+        if len(self.mdds) > self.max_mdds:
+            self.mdds.popitem(last=False)
+            self.num_evicted += 1
+        return mdd
+
+    def clear(self):
+        self.mdds.clear()
@@ -1,5 +1,5 @@
 import time as timer
-from single_agent_planner import compute_heuristics, a_star, get_sum_of_cost
+from single_agent_planner import compile_map, compute_heuristics, a_star, build_constraint_table, get_sum_of_cost
 
 
 class PrioritizedPlanningSolver(object):
@@ -12,6 +12,7 @@ class PrioritizedPlanningSolver(object):
         """
 
         self.my_map = my_map
+        self.graph = compile_map(my_map)
         self.starts = starts
         self.goals = goals
         self.num_of_agents = len(goals)
@@ -21,7 +22,7 @@ class PrioritizedPlanningSolver(object):
         # compute heuristics for the low-level search
         self.heuristics = []
         for goal in self.goals:
-            self.heuristics.append(compute_heuristics(my_map, goal))
+            self.heuristics.append(compute_heuristics(self.graph, goal))
 
     def find_solution(self):
         """ Finds paths for all agents from their start locations to their goal locations."""
@@ -31,7 +32,9 @@ class PrioritizedPlanningSolver(object):
         constraints = []
 
         for i in range(self.num_of_agents):  # Find path for each agent
-            path = a_star(self.my_map, self.starts[i], self.goals[i], self.heuristics[i], i, constraints)
+            # index the constraints of the current agent once, instead of scanning them at every expansion
+            constraint_table = build_constraint_table(constraints, i, self.graph)
+            path = a_star(self.graph, self.starts[i], self.goals[i], self.heuristics[i], i, constraint_table)
             if path is None:
                 raise BaseException('No solutions')
             result.append(path)
@@ -1,9 +1,68 @@
 import heapq
+from array import array
+from collections import deque
+import numpy as np
+
+# value of the uint16 distance tables for the cells that cannot reach each other
+UNREACHABLE = 0xFFFF
+# size of the blocks of rows of compute_distance_matrix, in bytes, and lower
+# bound in rows so that large maps do not run too many small blocks
+BLOCK_BYTES = 2 << 20
+MIN_BLOCK_ROWS = 64
+
+
+DIRECTIONS = [(0, -1), (1, 0), (0, 1), (-1, 0), (0, 0)]
 
 
 def move(loc, direction):
-    directions = [(0, -1), (1, 0), (0, 1), (-1, 0), (0,0)]
-    return loc[0] + directions[direction][0], loc[1] + directions[direction][1]
+    return loc[0] + DIRECTIONS[direction][0], loc[1] + DIRECTIONS[direction][1]
+
+
+def compile_map(my_map):
+    """Compile my_map into a graph over cell ids. This is done once per map, so
+    the searches do not repeat bounds and obstacle checks at every expansion.
+    my_map can use any of the encodings of the variants: True/False/'inbound'/
+    'outbound' or 1/0/2/3 (obstacle/free/inbound/outbound).
+
+    The successors of cell c are stored in CSR form:
+    graph['neighbors'][graph['offsets'][c]:graph['offsets'][c + 1]]
+    The first successor of a free cell is the cell itself (wait action), the
+    others are the adjacent free cells. Obstacles have no successors.
+    """
+    rows = len(my_map)
+    cols = len(my_map[0])
+    graph = {'rows': rows,
+             'cols': cols,
+             'num_cells': rows * cols,
+             'locs': [(r, c) for r in range(rows) for c in range(cols)],
+             'free': [],
+             'inbound': [],
+             'outbound': [],
+             'offsets': [0],
+             'neighbors': []}
+    for loc in graph['locs']:
+        cell = my_map[loc[0]][loc[1]]
+        graph['free'].append(cell != True)  # True and 1 are obstacles
+        graph['inbound'].append(cell == 'inbound' or cell == 2)
+        graph['outbound'].append(cell == 'outbound' or cell == 3)
+    for cell, loc in enumerate(graph['locs']):
+        if graph['free'][cell]:
+            graph['neighbors'].append(cell)
+            for direction in range(4):
+                child_loc = move(loc, direction)
+                if child_loc[0] < 0 or child_loc[0] >= rows \
+                        or child_loc[1] < 0 or child_loc[1] >= cols:
+                    continue
+                child_cell = child_loc[0] * cols + child_loc[1]
+                if graph['free'][child_cell]:
+                    graph['neighbors'].append(child_cell)
+        graph['offsets'].append(len(graph['neighbors']))
+    return graph
+
+
+def get_cell(graph, loc):
+    """Return the integer id of a location: cells are numbered row by row."""
+    return loc[0] * graph['cols'] + loc[1]
 
 
 def get_sum_of_cost(paths):
@@ -13,58 +72,315 @@ def get_sum_of_cost(paths):
     return rst
 
 
-def compute_heuristics(my_map, goal):
-    # Use Dijkstra to build a shortest-path tree rooted at the goal location
-    open_list = []
-    closed_list = dict()
-    root = {'loc': goal, 'cost': 0}
-    heapq.heappush(open_list, (root['cost'], goal, root))
-    closed_list[goal] = root
-    while len(open_list) > 0:
-        (cost, loc, curr) = heapq.heappop(open_list)
-        for direction in range(4):
-            child_loc = move(loc, direction)
-            child_cost = cost + 1
-            if child_loc[0] < 0 or child_loc[0] >= len(my_map) \
-                    or child_loc[1] < 0 or child_loc[1] >= len(my_map[0]):
-                continue
-            if my_map[child_loc[0]][child_loc[1]] == True:  # obstacle
-                continue
-            child = {'loc': child_loc, 'cost': child_cost}
-            if child_loc in closed_list:
-                existing_node = closed_list[child_loc]
-                if existing_node['cost'] > child_cost:
-                    closed_list[child_loc] = child
-                    heapq.heappush(open_list, (child_cost, child_loc, child))
-            else:
-                closed_list[child_loc] = child
-                heapq.heappush(open_list, (child_cost, child_loc, child))
+def compute_distance_matrix(graph, first=0, last=None, out=None):
+    """Return the distances between all pairs of cells as a dense uint16 matrix
+    indexed by cell id: matrix[goal][cell], UNREACHABLE if there is no path.
+    The breadth-first searches from every free cell run together, one layer at
+    a time, on flat (source * num_cells + cell) indices.
+    first, last     - only compute the rows of the goals first..last-1
+    out             - uint16 array of shape (last - first, num_cells) to fill
+                      instead of allocating the matrix
+    """
+    n = graph['num_cells']
+    rows = graph['rows']
+    cols = graph['cols']
+    if last is None:
+        last = n
+    cells = np.arange(n).reshape(rows, cols)
+    free = np.asarray(graph['free'], dtype=bool)
+    # offset[c][k]: change of cell id when moving from c in direction k, 0 if
+    # the move leaves the map or hits an obstacle (c itself is already reached)
+    offset = np.zeros((rows, cols, 4), dtype=np.int64)
+    for k in range(4):
+        dr, dc = DIRECTIONS[k]
+        src = cells[max(0, -dr):rows - max(0, dr), max(0, -dc):cols - max(0, dc)]
+        dst = cells[max(0, dr):rows - max(0, -dr), max(0, dc):cols - max(0, -dc)]
+        offset[max(0, -dr):rows - max(0, dr), max(0, -dc):cols - max(0, dc), k] = np.where(free[dst], dst - src, 0)
+    offset = offset.reshape(n, 4)
+
+    if out is None:
+        out = np.empty((last - first, n), dtype=np.uint16)
+    out.fill(UNREACHABLE)
+    # the searches run by blocks of rows, small enough for the rows being
+    # filled to stay in the CPU caches
+    block_size = max(MIN_BLOCK_ROWS, BLOCK_BYTES // (2 * n))
+    for block_first in range(first, last, block_size):
+        block_last = min(last, block_first + block_size)
+        matrix = out[block_first - first:block_last - first].reshape(-1)
+        sources = np.flatnonzero(free[block_first:block_last])
+        frontier = sources * n + sources + block_first
+        matrix[frontier] = 0
+        distance = 0
+        while frontier.size > 0:
+            distance += 1
+            frontier_cells = frontier % n
+            layer = []
+            # two entries of the frontier never reach the same pair through the same
+            # direction, and the pairs reached through an earlier direction are
+            # filtered out below, so the next layer has no duplicates
+            for k in range(4):
+                reached = frontier + offset[frontier_cells, k]
+                reached = reached[matrix[reached] == UNREACHABLE]
+                matrix[reached] = distance
+                layer.append(reached)
+            frontier = np.concatenate(layer)
+    return out
+
 
-    # build the heuristics table
-    h_values = dict()
-    for loc, node in closed_list.items():
-        h_values[loc] = node['cost']
+class DistanceTable(object):
+    """Lookups into an all-pairs distance matrix."""
+
+    def __init__(self, graph, matrix):
+        """graph    - compiled map, as returned by compile_map
+        matrix      - uint16 distances indexed by cell id, matrix[goal][cell]
+        """
+        self.graph = graph
+        self.matrix = matrix
+
+    def __getitem__(self, goal):
+        """Return the h_values of the goal location, as a_star expects them."""
+        return self.matrix[get_cell(self.graph, goal)].tolist()
+
+    def distance(self, loc1, loc2):
+        return int(self.matrix[get_cell(self.graph, loc1), get_cell(self.graph, loc2)])
+
+
+def compute_heuristics_for_complete_map(graph):
+    return DistanceTable(graph, compute_distance_matrix(graph))
+
+def compute_heuristics(graph, goal):
+    # Use a breadth-first search (Dijkstra with unit costs) to build a
+    # shortest-path tree rooted at the goal location.
+    # The table is a uint16 array indexed by cell id (see get_cell),
+    # UNREACHABLE for the cells that cannot reach the goal.
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    h_values = array('H', [UNREACHABLE]) * graph['num_cells']
+    goal_cell = get_cell(graph, goal)
+    h_values[goal_cell] = 0
+    open_list = deque([goal_cell])
+    while len(open_list) > 0:
+        cell = open_list.popleft()
+        child_cost = h_values[cell] + 1
+        # skip the first successor, which is the wait action
+        for child_cell in neighbors[offsets[cell] + 1:offsets[cell + 1]]:
+            if h_values[child_cell] == UNREACHABLE:
+                h_values[child_cell] = child_cost
+                open_list.append(child_cell)
     return h_values
 
 
-def build_constraint_table(constraints, agent):
+def build_constraint_table(constraints, agent, graph):
     ##############################
     # Task 1.2/1.3: Return a table that constains the list of constraints of
     #               the given agent for each time step. The table can be used
     #               for a more efficient constraint violation check in the 
     #               is_constrained function.
-    c_table = dict()
+    # vertex constraints are indexed by (timestep, cell) and edge constraints by
+    # (timestep, from, to), so that a lookup does not depend on how many
+    # constraints the agent has. 'max_timestep' is the latest constrained
+    # timestep: after it the agent is free to move anywhere.
+    # Positive constraints force the agent to a cell ('positive_vertex') or an
+    # edge ('positive_edge') at a timestep; 'positive_timestep' is the latest
+    # of them, before which the agent cannot stop at its goal.
+    # Barrier and range constraints (see add_constraint) are added as the
+    # vertex constraints they stand for. 'blocked' maps the cells that the
+    # agent cannot be at from a timestep on, forever (target constraints), to
+    # this timestep; 'goal' maps the cells to the timestep before which the
+    # agent cannot stop there.
+    # 'constraints' is the set of the constraints added to the table, which
+    # identifies it (see constraint_key).
+    c_table = {'constraints': frozenset(),
+               'vertex': set(),
+               'edge': set(),
+               'goal': dict(),
+               'blocked': dict(),
+               'positive_vertex': dict(),
+               'positive_edge': dict(),
+               'positive_timestep': -1,
+               'max_timestep': -1}
     for c in constraints:
-        # we need to consider only the constraints for the given agent
-        if c['agent'] == agent:
-            timestep = c['timestep']
-            if timestep not in c_table:
-                c_table[timestep] = [c]
-            else:
-                c_table[timestep].append(c)
+        # we need to consider only the constraints for the given agent, and
+        # the positive constraints of the others
+        if c['agent'] == agent or c.get('positive', False):
+            add_constraint(c_table, c, agent, graph)
     return c_table
 
 
+def add_constraint(c_table, c, agent, graph):
+    """Add the constraint c to the constraint table of agent. A positive
+    constraint of another agent forbids agent from colliding with it.
+    Besides the vertex and edge constraints, c can be of type:
+        'barrier'   - the agent cannot be at the cells of the straight line
+                      from c['loc'][0] to c['loc'][1] at the times that bring
+                      it to c['loc'][1] at c['timestep'], see get_barrier_states
+        'range'     - the agent cannot be at c['loc'][0] at any time up to
+                      c['timestep']
+        'target'    - the agent cannot be at c['loc'][0], the goal where another
+                      agent stays, at c['timestep'] or at any time after it
+        'length'    - the path of the agent is longer than c['timestep']: it
+                      cannot stop at c['loc'][0], its goal, by then
+        'release'   - the agent waits in the queue of c['loc'][0], its start
+                      station, until c['timestep']: it stays there up to then
+        'station'   - the agent is not on the station c['loc'][0] at
+                      c['timestep']: it neither moves nor stays there
+        'arrival'   - the agent does not move onto the station c['loc'][0]
+                      from another location at c['timestep']
+    """
+    c_table['constraints'] = c_table['constraints'] | {constraint_key(c)}
+    timestep = c['timestep']
+    cells = [get_cell(graph, loc) for loc in c['loc']]
+    if c.get('type') == 'barrier':
+        for loc, time in get_barrier_states(c):
+            add_vertex_constraint(c_table, time, get_cell(graph, loc))
+    elif c.get('type') == 'range':
+        for time in range(timestep + 1):
+            add_vertex_constraint(c_table, time, cells[0])
+    elif c.get('type') == 'target':
+        if c_table['blocked'].get(cells[0], timestep + 1) > timestep:
+            c_table['blocked'][cells[0]] = timestep
+        c_table['max_timestep'] = max(c_table['max_timestep'], timestep)
+    elif c.get('type') == 'length':
+        if c_table['goal'].get(cells[0], -1) < timestep + 1:
+            c_table['goal'][cells[0]] = timestep + 1
+        # the agent may have to wait at its goal until timestep + 1, which
+        # a_star only does before the last constrained timestep
+        c_table['max_timestep'] = max(c_table['max_timestep'], timestep + 1)
+    elif c.get('type') == 'release':
+        for time in range(1, timestep + 1):
+            c_table['positive_vertex'][time] = cells[0]
+        c_table['positive_timestep'] = max(c_table['positive_timestep'], timestep)
+        c_table['max_timestep'] = max(c_table['max_timestep'], timestep)
+    elif c.get('type') in ('station', 'arrival'):
+        for cell in graph['neighbors'][graph['offsets'][cells[0]]:graph['offsets'][cells[0] + 1]]:
+            if cell != cells[0] or c['type'] == 'station':
+                add_edge_constraint(c_table, timestep, cell, cells[0])
+    elif c['agent'] != agent:
+        if len(cells) == 1:
+            add_vertex_constraint(c_table, timestep, cells[0])
+        else:
+            add_vertex_constraint(c_table, timestep - 1, cells[0])
+            add_vertex_constraint(c_table, timestep, cells[1])
+            add_edge_constraint(c_table, timestep, cells[1], cells[0])
+    elif c.get('positive', False):
+        if len(cells) == 1:
+            c_table['positive_vertex'][timestep] = cells[0]
+        else:
+            c_table['positive_edge'][timestep] = (cells[0], cells[1])
+        c_table['positive_timestep'] = max(c_table['positive_timestep'], timestep)
+        c_table['max_timestep'] = max(c_table['max_timestep'], timestep)
+    elif len(cells) == 1:
+        add_vertex_constraint(c_table, timestep, cells[0])
+    else:
+        add_edge_constraint(c_table, timestep, cells[0], cells[1])
+
+
+def constraint_key(c):
+    return c['agent'], tuple(c['loc']), c['timestep'], c.get('positive', False), c.get('type')
+
+
+def get_barrier_states(c):
+    """Return the (location, timestep) pairs of the barrier constraint c: its
+    last cell at c['timestep'], and each cell before it on the straight line
+    from c['loc'][0] one timestep earlier (none before timestep 0)."""
+    (x1, y1), (x2, y2) = c['loc']
+    dx = (x1 > x2) - (x1 < x2)
+    dy = (y1 > y2) - (y1 < y2)
+    length = min(abs(x1 - x2) + abs(y1 - y2), c['timestep'])
+    return [((x2 + i * dx, y2 + i * dy), c['timestep'] - i) for i in range(length, -1, -1)]
+
+
+def add_vertex_constraint(c_table, timestep, cell):
+    c_table['vertex'].add((timestep, cell))
+    # latest timestep at which each cell is constrained
+    if c_table['goal'].get(cell, -1) < timestep:
+        c_table['goal'][cell] = timestep
+    if timestep > c_table['max_timestep']:
+        c_table['max_timestep'] = timestep
+
+
+def add_edge_constraint(c_table, timestep, from_cell, to_cell):
+    c_table['edge'].add((timestep, from_cell, to_cell))
+    if timestep > c_table['max_timestep']:
+        c_table['max_timestep'] = timestep
+
+
+def copy_constraint_table(c_table):
+    return {'constraints': c_table['constraints'],
+            'vertex': c_table['vertex'].copy(),
+            'edge': c_table['edge'].copy(),
+            'goal': c_table['goal'].copy(),
+            'blocked': c_table['blocked'].copy(),
+            'positive_vertex': c_table['positive_vertex'].copy(),
+            'positive_edge': c_table['positive_edge'].copy(),
+            'positive_timestep': c_table['positive_timestep'],
+            'max_timestep': c_table['max_timestep']}
+
+
+def paths_violate_constraint(constraint, paths):
+    """Return the agents, other than the agent of the positive constraint,
+    whose paths collide with it (see add_constraint)."""
+    loc = constraint['loc']
+    timestep = constraint['timestep']
+    agents = []
+    for agent, path in enumerate(paths):
+        if agent == constraint['agent']:
+            continue
+        if len(loc) == 1:
+            violated = get_location(path, timestep) == loc[0]
+        else:
+            prev_loc = get_location(path, timestep - 1)
+            curr_loc = get_location(path, timestep)
+            violated = prev_loc == loc[0] or curr_loc == loc[1] or (prev_loc == loc[1] and curr_loc == loc[0])
+        if violated:
+            agents.append(agent)
+    return agents
+
+
+def build_conflict_table(graph, paths, agent, stations=()):
+    """Return the table of the locations that the agents other than agent
+    occupy, which a search counts its collisions with (see count_conflicts).
+    Like the constraint tables, it is indexed by (timestep, cell) for the
+    vertices and by (timestep, from, to) for the moves, with the number of
+    agents there, and 'goal' maps the goals of the agents to the timesteps from
+    which they wait there. 'max_timestep' is the end of the longest path: after
+    it the table no longer depends on the time.
+    stations    - locations where the agents never have vertex collisions
+    """
+    station_cells = {get_cell(graph, loc) for loc in stations}
+    table = {'vertex': dict(),
+             'edge': dict(),
+             'goal': dict(),
+             'max_timestep': -1}
+    for other, path in enumerate(paths):
+        if other == agent or len(path) == 0:
+            continue
+        cells = [get_cell(graph, loc) for loc in path]
+        for t, cell in enumerate(cells):
+            if cell not in station_cells:
+                table['vertex'][(t, cell)] = table['vertex'].get((t, cell), 0) + 1
+            if t > 0 and cells[t - 1] != cell:
+                key = (t, cells[t - 1], cell)
+                table['edge'][key] = table['edge'].get(key, 0) + 1
+        if cells[-1] not in station_cells:
+            # the agent waits at its goal after the end of its path
+            table['goal'].setdefault(cells[-1], []).append(len(cells))
+        table['max_timestep'] = max(table['max_timestep'], len(cells) - 1)
+    return table
+
+
+def count_conflicts(conflict_table, curr_loc, next_loc, next_time):
+    """Return the number of agents of the conflict table that a move from
+    curr_loc to next_loc at time step next_time collides with."""
+    conflicts = conflict_table['vertex'].get((next_time, next_loc), 0)
+    for arrival in conflict_table['goal'].get(next_loc, ()):
+        if arrival <= next_time:
+            conflicts += 1
+    if curr_loc != next_loc:
+        conflicts += conflict_table['edge'].get((next_time, next_loc, curr_loc), 0)
+    return conflicts
+
+
 def get_location(path, time):
     if time < 0:
         return path[0]
@@ -74,12 +390,12 @@ def get_location(path, time):
         return path[-1]  # wait at the goal location
 
 
-def get_path(goal_node):
+def get_path(goal_node, node_cell, node_parent, locs):
     path = []
     curr = goal_node
-    while curr is not None:
-        path.append(curr['loc'])
-        curr = curr['parent']
+    while curr != -1:
+        path.append(locs[node_cell[curr]])
+        curr = node_parent[curr]
     path.reverse()
     return path
 
@@ -92,90 +408,319 @@ def flatten_constraints(list_of_constraints_list):
     return constraints
 
 
-def is_constrained(curr_loc, next_loc, next_time, constraint_list):
+def is_constrained(curr_loc, next_loc, next_time, constraint_table):
     """
     Check if a move from curr_loc to next_loc at time step next_time violates
     any given constraint. 
     """
-    for constraint in constraint_list:
-        if constraint['timestep'] == next_time:
-            if len(constraint['loc']) == 1:  # vertex constraint
-                if constraint['loc'][0] == next_loc:
-                    return True
-            else:  # edge constraint
-                if constraint['loc'][0] == curr_loc and constraint['loc'][1] == next_loc:
-                    return True
-    return False
+    if next_time > constraint_table['max_timestep']:
+        # a target constraint holds forever, the others are over
+        return next_loc in constraint_table['blocked']
+    if (next_time, next_loc) in constraint_table['vertex']:
+        return True
+    if constraint_table['blocked'].get(next_loc, next_time + 1) <= next_time:
+        return True
+    if (next_time, curr_loc, next_loc) in constraint_table['edge']:
+        return True
+    # a positive constraint at next_time rules out every other move
+    positive = constraint_table['positive_vertex'].get(next_time)
+    if positive is not None and positive != next_loc:
+        return True
+    positive = constraint_table['positive_edge'].get(next_time)
+    return positive is not None and positive != (curr_loc, next_loc)
 
 def is_goal_constrained(goal_loc, timestep, constraint_table):
     """
-    checks if there's a constraint on the goal in the future.
+    checks if there's a constraint on the goal, or a positive constraint, in the future.
+    The agent can never stop at a goal that has to stay free from a timestep on.
     goal_loc            - goal location
     timestep            - current timestep
     constraint_table    - generated constraint table for current agent
     """
-    constraints = [c for t, c in constraint_table.items() if t > timestep]
-    constraints = flatten_constraints(constraints)
-    for c in constraints:
-        if [goal_loc] == c['loc']:
-            return True
-    return False
+    return constraint_table['goal'].get(goal_loc, -1) > timestep or constraint_table['positive_timestep'] > timestep \
+        or goal_loc in constraint_table['blocked']
 
 
-def push_node(open_list, node):
-    heapq.heappush(open_list, (node['g_val'] + node['h_val'], node['h_val'], node['loc'], node))
+def push_node(open_list, g_val, h_val, cell, node, conflicts=0):
+    heapq.heappush(open_list, (g_val + h_val, conflicts, h_val, cell, node))
 
 
 def pop_node(open_list):
-    _, _, _, curr = heapq.heappop(open_list)
-    return curr
+    return heapq.heappop(open_list)[-1]
+
+
+def record_stats(stats, num_expanded, num_generated):
+    if stats is not None:
+        stats['expanded'] = stats.get('expanded', 0) + num_expanded
+        stats['generated'] = stats.get('generated', 0) + num_generated
 
 
-def compare_nodes(n1, n2):
-    """Return true is n1 is better than n2."""
-    return n1['g_val'] + n1['h_val'] < n2['g_val'] + n2['h_val']
+def get_leg_heuristics(graph, waypoints, heuristics):
+    """Return the cells of the waypoints, and for each leg the cost of the legs
+    after it: a path stays one timestep at each waypoint it goes through, where
+    a leg ends and the next one starts (see a_star_waypoints)."""
+    cells = [get_cell(graph, loc) for loc in waypoints]
+    rest = [0] * len(waypoints)
+    for leg in range(len(waypoints) - 2, 0, -1):
+        rest[leg] = rest[leg + 1] + 1 + heuristics[waypoints[leg + 1]][cells[leg]]
+    return cells, rest
 
 
-def a_star(my_map, start_loc, goal_loc, h_values, agent, constraints):
-    """ my_map      - binary obstacle map
-        start_loc   - start position
-        goal_loc    - goal position
-        agent       - the agent that is being re-planned
-        constraints - constraints defining where robot should or cannot go at each timestep
+def a_star(graph, start_loc, goal_loc, h_values, agent, constraint_table, stats=None, conflict_table=None):
+    """ graph               - compiled map, as returned by compile_map
+        start_loc           - start position
+        goal_loc            - goal position
+        h_values            - distances to the goal (or lower bounds), indexed by cell id
+        agent               - the agent that is being re-planned
+        constraint_table    - constraints of the agent, as returned by build_constraint_table
+        stats               - optional dict, the numbers of 'expanded' and 'generated'
+                              nodes of the search are added to it
+        conflict_table      - optional conflict-avoidance table, the locations of the other
+                              agents (see build_conflict_table): among the nodes of the same
+                              f-value, the ones whose path collides with the fewest of them
+                              are expanded first, which keeps the path one of the shortest
     """
+    return space_time_a_star(graph, [start_loc, goal_loc], [None, h_values], [0, 0], constraint_table, stats,
+                             conflict_table)
+
+
+def a_star_waypoints(graph, waypoints, heuristics, agent, constraint_table, conflict_table=None, stats=None):
+    """Return the shortest path of agent through the waypoints one after the
+    other, or None if there is none. The path stays one timestep at each
+    waypoint between two legs (it appears twice in a row), and the timesteps of
+    the constraints are those of the whole path.
+    heuristics          - heuristic provider, see heuristics.build_heuristics
+    The other parameters are those of a_star.
+    """
+    _, rest = get_leg_heuristics(graph, waypoints, heuristics)
+    h_tables = [None] + [heuristics[loc] for loc in waypoints[1:]]
+    return space_time_a_star(graph, waypoints, h_tables, rest, constraint_table, stats, conflict_table)
+
 
+def space_time_a_star(graph, waypoints, h_tables, rest, constraint_table, stats=None, conflict_table=None):
+    """Return the shortest path through the waypoints under the constraints,
+    from a single A* search over (cell, leg, time): the leg of a node is the
+    index of the next waypoint, and a node at this waypoint moves on to the
+    next leg by staying there one timestep. The h-value of a node is the
+    distance to its next waypoint plus the cost of the legs after it.
+        h_tables            - distances to each waypoint (but the first), indexed by cell id
+        rest                - cost of the legs after each leg, see get_leg_heuristics
+    The other parameters are those of a_star.
+    """
+
+    # search nodes are kept in parallel lists indexed by node id. Every action
+    # (wait included) costs 1, so the g-value of a node is its time.
+    node_cell = []
+    node_leg = []
+    node_time = []
+    node_parent = []
+    node_conflicts = []
     open_list = []
+    # a (cell, leg, time) state is reached with the same g-value whatever the
+    # path, so the first node generated for it is never improved upon, except
+    # by a node of fewer collisions with the conflict table before it is expanded
     closed_list = dict()
-    h_value = h_values[start_loc]
-    root = {'loc': start_loc, 'g_val': 0, 'h_val': h_value, 'parent': None, 'time': 0}
-    push_node(open_list, root)
-    closed_list[(start_loc, 0)] = root
+    expanded = set()
+    # from the last constrained timestep on, the time no longer matters: only
+    # the earliest node of each (cell, leg) is kept, so the search does not
+    # re-expand every cell at every later timestep (and stops when the goal is
+    # unreachable)
+    horizon = constraint_table['max_timestep']
+    earliest = dict()
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    num_cells = graph['num_cells']
+    num_legs = len(waypoints)
+    last_leg = num_legs - 1
+    cells = [get_cell(graph, loc) for loc in waypoints]
+    start = cells[0]
+    goal = cells[-1]
+    node_cell.append(start)
+    node_leg.append(1)
+    node_time.append(0)
+    node_parent.append(-1)
+    node_conflicts.append(0)
+    push_node(open_list, 0, h_tables[1][start] + rest[1], start, 0)
+    if horizon <= 0:
+        earliest[start * num_legs + 1] = 0
+    else:
+        closed_list[start * num_legs + 1] = 0
+    num_expanded = 0
     while len(open_list) > 0:
         curr = pop_node(open_list)
-        if curr['loc'] == goal_loc:
-            return get_path(curr)
-        for direction in range(5):
-            child_loc = move(curr['loc'], direction) if direction < 4 else curr['loc']  # Add wait action
-            if child_loc[0] < 0 or child_loc[0] >= len(my_map) \
-                    or child_loc[1] < 0 or child_loc[1] >= len(my_map[0]):
-                continue
-            if my_map[child_loc[0]][child_loc[1]] == True:  # obstacle
-                continue
-            child = {'loc': child_loc,
-                     'g_val': curr['g_val'] + 1,
-                     'h_val': h_values[child_loc],
-                     'parent': curr,
-                     'time': curr['time'] + 1}
+        cell = node_cell[curr]
+        leg = node_leg[curr]
+        time = node_time[curr]
+        if time >= horizon:
+            if earliest[cell * num_legs + leg] < time:
+                continue  # the state was reached earlier since this node was generated
+        elif closed_list[(time * num_cells + cell) * num_legs + leg] != curr:
+            continue  # the node was replaced by one of fewer collisions
+        if leg == last_leg and cell == goal and not is_goal_constrained(goal, time, constraint_table):
+            record_stats(stats, num_expanded, len(node_cell))
+            return get_path(curr, node_cell, node_parent, graph['locs'])
+        num_expanded += 1
+        expanded.add(curr)
+        child_time = time + 1
+        children = [(child_cell, leg) for child_cell in neighbors[offsets[cell]:offsets[cell + 1]]]
+        if leg < last_leg and cell == cells[leg]:
+            children.append((cell, leg + 1))
+        for child_cell, child_leg in children:
+            h_val = h_tables[child_leg][child_cell]
             # check if the child violates the constraints
-            if is_constrained(curr['loc'], child['loc'], child['time'], constraints):
+            if h_val >= UNREACHABLE or is_constrained(cell, child_cell, child_time, constraint_table):
                 continue
-            if (child['loc'], child['time']) in closed_list:
-                existing_node = closed_list[(child['loc'], child['time'])]
-                if compare_nodes(child, existing_node):
-                    closed_list[(child['loc'], child['time'])] = child
-                    push_node(open_list, child)
+            conflicts = node_conflicts[curr]
+            if conflict_table is not None:
+                conflicts += count_conflicts(conflict_table, cell, child_cell, child_time)
+            child = len(node_cell)
+            if child_time >= horizon:
+                key = child_cell * num_legs + child_leg
+                if earliest.get(key, child_time + 1) <= child_time:
+                    continue
+                earliest[key] = child_time
             else:
-                closed_list[(child['loc'], child['time'])] = child
-                push_node(open_list, child)
+                key = (child_time * num_cells + child_cell) * num_legs + child_leg
+                other = closed_list.get(key)
+                if other is not None and (other in expanded or node_conflicts[other] <= conflicts):
+                    continue
+                closed_list[key] = child
+            node_cell.append(child_cell)
+            node_leg.append(child_leg)
+            node_time.append(child_time)
+            node_parent.append(curr)
+            node_conflicts.append(conflicts)
+            push_node(open_list, child_time, h_val + rest[child_leg], child_cell, child, conflicts)
 
+    record_stats(stats, num_expanded, len(node_cell))
     return None  # Failed to find solutions
+
+
+def focal_a_star_waypoints(graph, waypoints, heuristics, agent, constraint_table, suboptimality, conflict_table,
+                           stats=None):
+    """Return the path of agent through the waypoints from a focal search over
+    the states of a_star_waypoints, which costs at most suboptimality times the
+    lowest cost, along with a lower bound on the lowest cost (None, None if
+    there is none). Among the nodes whose f-value is at most suboptimality
+    times the lowest f-value in the open list, the focal search expands the
+    ones whose path collides with the fewest agents of the conflict table
+    first, as the low level of ECBS.
+        suboptimality       - factor of the lowest cost that the path is within
+        conflict_table      - locations of the other agents, see build_conflict_table
+    The other parameters are those of a_star_waypoints.
+    """
+    node_cell = []
+    node_leg = []
+    node_time = []
+    node_parent = []
+    node_conflicts = []
+    # the nodes are in the open list by f-value, and in the focal list by
+    # number of collisions once their f-value is within the bound
+    open_list = []
+    focal_list = []
+    pending_list = []
+    expanded = []
+    # best node of each (cell, leg, time) state, or of each (cell, leg) from
+    # the horizon on: a node generated with fewer collisions replaces the one
+    # not expanded yet
+    best = dict()
+    horizon = max(constraint_table['max_timestep'], conflict_table['max_timestep'])
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    cells, rest = get_leg_heuristics(graph, waypoints, heuristics)
+    h_tables = [None] + [heuristics[loc] for loc in waypoints[1:]]
+    last_leg = len(waypoints) - 1
+    goal = cells[-1]
+
+    def get_key(cell, leg, time):
+        return (time, cell, leg) if time < horizon else (cell, leg)
+
+    def push(cell, leg, time, parent, conflicts):
+        node = len(node_cell)
+        node_cell.append(cell)
+        node_leg.append(leg)
+        node_time.append(time)
+        node_parent.append(parent)
+        node_conflicts.append(conflicts)
+        expanded.append(False)
+        best[get_key(cell, leg, time)] = node
+        h_val = h_tables[leg][cell] + rest[leg]
+        heapq.heappush(open_list, (time + h_val, h_val, node))
+        heapq.heappush(pending_list, (time + h_val, h_val, node))
+
+    def is_open(node):
+        return not expanded[node] and best[get_key(node_cell[node], node_leg[node], node_time[node])] == node
+
+    push(cells[0], 1, 0, -1, 0)
+    bound = 0
+    num_expanded = 0
+    while True:
+        while open_list and not is_open(open_list[0][2]):
+            heapq.heappop(open_list)
+        if not open_list:
+            record_stats(stats, num_expanded, len(node_cell))
+            return None, None  # Failed to find solutions
+        lower_bound = open_list[0][0]
+        # the lowest f-value never decreases, so the nodes only move into the focal list
+        bound = max(bound, suboptimality * lower_bound)
+        while pending_list and pending_list[0][0] <= bound:
+            f_val, h_val, node = heapq.heappop(pending_list)
+            heapq.heappush(focal_list, (node_conflicts[node], f_val, h_val, node))
+        _, _, _, curr = heapq.heappop(focal_list)
+        if not is_open(curr):
+            continue
+        cell = node_cell[curr]
+        leg = node_leg[curr]
+        time = node_time[curr]
+        if leg == last_leg and cell == goal and not is_goal_constrained(goal, time, constraint_table):
+            record_stats(stats, num_expanded, len(node_cell))
+            return get_path(curr, node_cell, node_parent, graph['locs']), lower_bound
+        expanded[curr] = True
+        num_expanded += 1
+        child_time = time + 1
+        children = [(child_cell, leg) for child_cell in neighbors[offsets[cell]:offsets[cell + 1]]]
+        if leg < last_leg and cell == cells[leg]:
+            children.append((cell, leg + 1))
+        for child_cell, child_leg in children:
+            if h_tables[child_leg][child_cell] >= UNREACHABLE or \
+                    is_constrained(cell, child_cell, child_time, constraint_table):
+                continue
+            conflicts = node_conflicts[curr] + count_conflicts(conflict_table, cell, child_cell, child_time)
+            other = best.get(get_key(child_cell, child_leg, child_time))
+            if other is not None:
+                if child_time < horizon:
+                    if expanded[other] or node_conflicts[other] <= conflicts:
+                        continue
+                elif (node_time[other], node_conflicts[other]) <= (child_time, conflicts):
+                    continue
+            push(child_cell, child_leg, child_time, curr, conflicts)
+
+
+def get_travel_time(graph, start_loc, goal_loc, constraint_table, upper_bound=None, blocked_edges=()):
+    """Return the earliest timestep at which the agent can be at goal_loc,
+    from start_loc at timestep 0, under its constraints. Unlike a_star, the
+    agent does not need to stay at goal_loc afterwards. Return upper_bound if
+    it cannot be there before (or at all).
+    blocked_edges   - moves (from_cell, to_cell) that are forbidden at every timestep
+    """
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    goal = get_cell(graph, goal_loc)
+    # every move costs 1, so the cells reachable at each timestep are expanded
+    # one timestep after the other
+    layer = {get_cell(graph, start_loc)}
+    time = 0
+    while goal not in layer:
+        if upper_bound is not None and time >= upper_bound:
+            return upper_bound
+        time += 1
+        next_layer = set()
+        for cell in layer:
+            for child_cell in neighbors[offsets[cell]:offsets[cell + 1]]:
+                if (cell, child_cell) in blocked_edges or is_constrained(cell, child_cell, time, constraint_table):
+                    continue
+                next_layer.add(child_cell)
+        if time > constraint_table['max_timestep'] and next_layer == layer:
+            return upper_bound  # no more constraints and no new cell: the goal is unreachable
+        layer = next_layer
+    return time
@@ -0,0 +1,203 @@
+import heapq
+from cbs import DEBUG, CBSSolver, update_collisions
+from single_agent_planner import build_conflict_table, focal_a_star_waypoints, get_sum_of_cost
+
+# factor of the lowest sum of costs that the solutions are within
+SUBOPTIMALITY = 1.2
+
+
+class FocalList(object):
+    """The focal list of a focal search: the nodes whose value is at most a
+    bound, ordered by their number of collisions. The nodes above the bound
+    wait in a list ordered by value, and move in and out of the focal list as
+    the bound changes."""
+
+    def __init__(self, value):
+        """value    - key of the nodes compared to the bound, 'cost' or 'f_hat'"""
+        self.value = value
+        self.focal_list = []
+        self.pending_list = []
+
+    def push(self, node, id):
+        heapq.heappush(self.pending_list, (node[self.value], id, node))
+
+    def top(self, bound, closed):
+        """Return the id and the node of the focal list with the fewest
+        collisions under bound, or None if there is none. The nodes whose id is
+        in closed were expanded and are dropped."""
+        while self.pending_list and self.pending_list[0][0] <= bound:
+            value, id, node = heapq.heappop(self.pending_list)
+            heapq.heappush(self.focal_list, (len(node['collisions']), value, id, node))
+        while self.focal_list:
+            _, value, id, node = self.focal_list[0]
+            if id in closed:
+                heapq.heappop(self.focal_list)
+            elif value > bound:
+                # the bound went down since the node moved into the focal list
+                heapq.heappop(self.focal_list)
+                heapq.heappush(self.pending_list, (value, id, node))
+            else:
+                return id, node
+        return None
+
+
+class ECBSSolver(CBSSolver):
+    """Bounded-suboptimal CBS: ECBS, or EECBS with explicit estimation. The
+    paths of the agents are found by a focal search (see focal_a_star_waypoints), within
+    suboptimality times their lowest cost under their constraints, which gives
+    a lower bound on the cost of each node. The high level is a focal search
+    too: among the nodes whose cost is within suboptimality times the lowest
+    lower bound in the open list, it expands the ones with the fewest
+    collisions first, so the solution is within suboptimality times the lowest
+    sum of costs.
+
+    EECBS (explicit_estimation) orders the open list by an estimate of the cost
+    of the solutions under each node instead, the cost plus the number of its
+    collisions times the cost that a collision adds on average, learned over
+    the search. It expands the node with the fewest collisions among those
+    whose estimate is within suboptimality times the lowest one, if its cost
+    is within the bound, else the node of lowest estimate, if its cost is,
+    else the node of lowest lower bound.
+
+    The meta-agents of CBSSolver are not merged, and the CBS heuristics
+    (high_level_heuristic) are not used."""
+
+    def __init__(self, my_map, starts, goals, suboptimality=SUBOPTIMALITY, explicit_estimation=False, **options):
+        """suboptimality    - factor of the lowest sum of costs that the solution is within
+        explicit_estimation - run EECBS rather than ECBS
+        The other parameters are those of CBSSolver.
+        """
+        super().__init__(my_map, starts, goals, **options)
+        self.suboptimality = suboptimality
+        self.explicit_estimation = explicit_estimation
+        self.merge_threshold = None
+        # the open list of CBSSolver is ordered by lower bound (the cleanup
+        # list of EECBS); EECBS orders its open list by estimate
+        self.estimate_list = []
+        self.focal_list = FocalList('f_hat' if explicit_estimation else 'cost')
+        self.closed = set()
+        # average cost and number of collisions that the splits add (EECBS)
+        self.num_of_splits = 0
+        self.cost_error = 0
+        self.distance_error = 0
+        # lowest lower bound when the solution was found, and the factor of
+        # it that the cost of the solution is within
+        self.lower_bound = 0
+        self.suboptimality_bound = None
+
+    def get_lower_bound(self):
+        while self.open_list and self.open_list[0][1] in self.closed:
+            heapq.heappop(self.open_list)
+        return self.open_list[0][0] if self.open_list else None
+
+    def estimate(self, node):
+        """Return the estimate of the cost of the solutions under node (the
+        f-hat value of EECBS), and learn the errors of the estimates from the
+        split of its parent."""
+        parent = node['parent']
+        if parent is not None and node['constraint'] is not None:
+            self.num_of_splits += 1
+            cost_error = max(0, node['cost'] - parent['cost'])
+            distance_error = len(node['collisions']) - len(parent['collisions']) + 1
+            self.cost_error += (cost_error - self.cost_error) / self.num_of_splits
+            self.distance_error += (distance_error - self.distance_error) / self.num_of_splits
+        distance = len(node['collisions'])
+        if self.distance_error < 1:
+            distance /= 1 - self.distance_error
+        return node['cost'] + distance * self.cost_error
+
+    def push_node(self, node):
+        id = self.num_of_generated
+        heapq.heappush(self.open_list, (node['lower_bound'], id, node))
+        if self.explicit_estimation:
+            node['f_hat'] = self.estimate(node)
+            heapq.heappush(self.estimate_list, (node['f_hat'], id, node))
+        self.focal_list.push(node, id)
+        if DEBUG:
+            print("Generate node {}".format(id))
+        self.num_of_generated += 1
+
+    def pop_node(self):
+        """Return the next node to expand, None if there is none left."""
+        lower_bound = self.get_lower_bound()
+        if lower_bound is None:
+            return None
+        bound = self.suboptimality * lower_bound
+        if self.explicit_estimation:
+            while self.estimate_list[0][1] in self.closed:
+                heapq.heappop(self.estimate_list)
+            f_hat, id, node = self.estimate_list[0]
+            best = self.focal_list.top(self.suboptimality * f_hat, self.closed)
+            if best is not None and best[1]['cost'] <= bound:
+                id, node = best
+            elif node['cost'] > bound:
+                _, id, node = self.open_list[0]
+        else:
+            best = self.focal_list.top(bound, self.closed)
+            if best is None:
+                _, id, node = self.open_list[0]
+            else:
+                id, node = best
+        self.closed.add(id)
+        self.lower_bound = lower_bound
+        if DEBUG:
+            print("Expand node {}".format(id))
+            self.num_of_expanded += 1
+        return node
+
+    def plan_focal_path(self, agent, constraint_table, paths):
+        """Return the path of agent found by a focal search that avoids the
+        other paths, and the lower bound on its cost, see focal_a_star_waypoints."""
+        conflict_table = build_conflict_table(self.graph, paths, agent, self.stations)
+        return focal_a_star_waypoints(self.graph, self.choose_waypoints(agent), self.heuristics, agent,
+                                      constraint_table, self.suboptimality, conflict_table)
+
+    def plan_root(self, root):
+        """Plan the path of each agent at the root, avoiding the agents before
+        it, and the lower bounds of the root ('lower_bounds' of the agents and
+        their sum, 'lower_bound')."""
+        root['lower_bounds'] = []
+        for i in range(len(root['meta_agents'])):
+            path, lower_bound = self.plan_focal_path(i, self.get_constraint_table(root, i), root['paths'])
+            if path is None:
+                raise BaseException('No solutions')
+            root['paths'].append(path)
+            root['lower_bounds'].append(lower_bound)
+        root['lower_bound'] = sum(root['lower_bounds'])
+
+    def replan(self, q, p, p_paths, agents, node_limit=None):
+        """Replan the agents at the child q of p with a focal search, and
+        update the cost, the collisions and the lower bounds of q. Return False
+        if one of the agents has no path."""
+        q['cost'] = p['cost']
+        q['collisions'] = p['collisions']
+        q['lower_bounds'] = p['lower_bounds'].copy()
+        paths = p_paths
+        for agent in agents:
+            path, lower_bound = self.plan_focal_path(agent, self.get_constraint_table(q, agent), paths)
+            if path is None:
+                return False
+            q['replanned'][agent] = path
+            q['collisions'] = update_collisions(q['collisions'], paths, agent, path, self.stations)
+            q['cost'] += len(path) - len(paths[agent])
+            # the constraints of q include those of p
+            q['lower_bounds'][agent] = max(q['lower_bounds'][agent], lower_bound)
+            paths = paths.copy()
+            paths[agent] = path
+        q['collisions'] = self.update_station_conflicts(q['collisions'], paths)
+        q['lower_bound'] = sum(q['lower_bounds'])
+        return True
+
+    def get_mdd(self, node, agent):
+        """Return the MDD of agent at node, see CBSSolver.get_mdd, or None if
+        its path may not be one of the shortest."""
+        if len(self.get_paths(node)[agent]) - 1 > node['lower_bounds'][agent]:
+            return None
+        return super().get_mdd(node, agent)
+
+    def print_results(self, node):
+        super().print_results(node)
+        cost = get_sum_of_cost(node['paths'])
+        self.suboptimality_bound = cost / self.lower_bound if self.lower_bound > 0 else 1.0
+        print("Lower bound:     {}".format(self.lower_bound))
+        print("Suboptimality:   {:.3f} (bound {})".format(self.suboptimality_bound, self.suboptimality))
@@ -0,0 +1,136 @@
+import heapq
+from single_agent_planner import UNREACHABLE, get_cell, get_leg_heuristics, is_constrained, is_goal_constrained
+
+# expansions of the coupled search of a meta-agent, after which it gives up
+META_AGENT_NODE_LIMIT = 10000
+
+
+def plan_meta_agent(graph, waypoints, heuristics, constraint_tables, stations=(),
+                    node_limit=META_AGENT_NODE_LIMIT):
+    """Return the paths of the agents of a meta-agent that do not collide with
+    each other, of the lowest sum of costs under their constraints, from an A*
+    search over their joint states with operator decomposition: the agents of a
+    node move one after the other, so that the search only generates the moves
+    of one agent at a time. None if there are none, or none within node_limit
+    expansions (None for no limit).
+    waypoints           - for each agent, the locations it goes through one leg
+                          after the other, see CBSSolver.get_waypoints
+    heuristics          - heuristic provider, see heuristics.build_heuristics
+    constraint_tables   - constraint table of each agent
+    stations            - locations where the agents never have vertex collisions
+    """
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    num_agents = len(waypoints)
+    station_cells = {get_cell(graph, loc) for loc in stations}
+    legs = [get_leg_heuristics(graph, agent_waypoints, heuristics) for agent_waypoints in waypoints]
+    last_legs = [len(agent_waypoints) - 1 for agent_waypoints in waypoints]
+    horizon = max(table['max_timestep'] for table in constraint_tables)
+
+    def get_h(agent, state):
+        cell, leg, _ = state
+        if leg == last_legs[agent] and cell == legs[agent][0][leg]:
+            return 0
+        return heuristics[waypoints[agent][leg]][cell] + legs[agent][1][leg]
+
+    def is_goal(agent, state, time):
+        # an agent that waits for free at its goal stopped there before
+        cell, leg, wait = state
+        return leg == last_legs[agent] and cell == legs[agent][0][leg] \
+            and (wait > 0 or not is_goal_constrained(cell, time, constraint_tables[agent]))
+
+    # the state of an agent is (cell, leg, wait): its next waypoint is
+    # waypoints[leg], and it waited for the last wait timesteps at its goal,
+    # which are only counted in its cost if it moves again
+    start = tuple((legs[agent][0][0], 1, 0) for agent in range(num_agents))
+    h = sum(get_h(agent, state) for agent, state in enumerate(start))
+    if h >= UNREACHABLE:
+        return None
+    # the joint states of the timesteps, with the index of the state before
+    states = [(start, -1)]
+    # nodes are (f, h, id, g, time, index of the joint state, moves of the
+    # agents so far): the node is a joint state once every agent moved
+    open_list = [(h, h, 0, 0, 0, 0, ())]
+    num_generated = 1
+    closed_list = set()
+    num_expanded = 0
+    while open_list:
+        _, h, _, g, time, index, moves = heapq.heappop(open_list)
+        joint_state = states[index][0]
+        if not moves:
+            # after the last constrained timestep, the time no longer matters
+            key = joint_state if time > horizon else (time, joint_state)
+            if key in closed_list:
+                continue
+            closed_list.add(key)
+            if all(is_goal(agent, state, time) for agent, state in enumerate(joint_state)):
+                return get_paths(graph, states, index, time)
+        if num_expanded == node_limit:
+            return None
+        num_expanded += 1
+        agent = len(moves)
+        cell, leg, wait = joint_state[agent]
+        child_time = time + 1
+        at_goal = leg == last_legs[agent] and cell == legs[agent][0][leg]
+        children = [(child_cell, leg, 0) for child_cell in neighbors[offsets[cell]:offsets[cell + 1]]]
+        if leg < last_legs[agent] and cell == legs[agent][0][leg]:
+            # the agent stays one timestep at the waypoint, where its next leg
+            # starts, or goes through it to come back later
+            children.append((cell, leg + 1, 0))
+        for child in children:
+            child_cell = child[0]
+            if is_constrained(cell, child_cell, child_time, constraint_tables[agent]):
+                continue
+            if collides(joint_state, moves, cell, child_cell, station_cells):
+                continue
+            if not at_goal:
+                cost = 1
+            elif child_cell != cell:
+                cost = wait + 1  # the agent leaves its goal: its waits count
+            elif wait > 0 or not is_goal_constrained(cell, time, constraint_tables[agent]):
+                cost = 0  # the agent may have stopped at its goal
+                child = (cell, leg, wait + 1)
+            else:
+                cost = 1
+            child_h = h - get_h(agent, joint_state[agent]) + get_h(agent, child)
+            if child_h >= UNREACHABLE:
+                continue
+            child_moves = moves + (child,)
+            child_index = index
+            child_g = g + cost
+            if len(child_moves) < num_agents:
+                heapq.heappush(open_list, (child_g + child_h, child_h, num_generated, child_g, time, index,
+                                           child_moves))
+            else:
+                child_index = len(states)
+                states.append((child_moves, index))
+                heapq.heappush(open_list, (child_g + child_h, child_h, num_generated, child_g, child_time,
+                                           child_index, ()))
+            num_generated += 1
+    return None
+
+
+def collides(joint_state, moves, cell, child_cell, station_cells):
+    """Return True if an agent that moves from cell to child_cell collides with
+    the agents that already moved."""
+    for other, other_child in enumerate(moves):
+        other_cell = joint_state[other][0]
+        if other_child[0] == child_cell and child_cell not in station_cells:
+            return True  # vertex collision
+        if other_child[0] == cell and other_cell == child_cell and child_cell != cell:
+            return True  # edge collision
+    return False
+
+
+def get_paths(graph, states, index, time):
+    """Return the paths of the agents up to the joint state states[index] at
+    time, each one ending when the agent stopped at its goal."""
+    joint_states = []
+    while index != -1:
+        joint_state, index = states[index]
+        joint_states.append(joint_state)
+    joint_states.reverse()
+    paths = []
+    for agent, (_, _, wait) in enumerate(joint_states[-1]):
+        paths.append([graph['locs'][joint_state[agent][0]] for joint_state in joint_states[:time - wait + 1]])
+    return paths
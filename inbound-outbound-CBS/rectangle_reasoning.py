@@ -0,0 +1,239 @@
+import time as timer
+from mdd import CARDINAL, SEMI_CARDINAL, NON_CARDINAL, get_mdd_level
+from single_agent_planner import get_cell, get_location, get_barrier_states
+
+
+def manhattan_distance(loc1, loc2):
+    return abs(loc1[0] - loc2[0]) + abs(loc1[1] - loc2[1])
+
+
+def is_rectangle_conflict(s1, s2, g1, g2):
+    """Return True if the two agents, moving on Manhattan-optimal paths from s1
+    to g1 and from s2 to g2, have a rectangle conflict: they move in the same
+    directions and each has to cross the path of the other."""
+    return not (s1 == s2 or  # a standard cardinal conflict
+                s1 == g1 or s2 == g2 or
+                (s1[0] - g1[0]) * (s2[0] - g2[0]) < 0 or
+                (s1[1] - g1[1]) * (s2[1] - g2[1]) < 0 or  # not the same directions
+                ((s2[0] - s1[0]) * (s1[0] - g1[0]) < 0 and
+                 (s2[1] - s1[1]) * (s1[1] - g1[1]) < 0) or  # s1 always in the middle
+                ((s1[0] - s2[0]) * (s2[0] - g2[0]) < 0 and
+                 (s1[1] - s2[1]) * (s2[1] - g2[1]) < 0) or  # s2 always in the middle
+                (s1[0] == g1[0] and s2[1] == g2[1]) or
+                (s1[1] == g1[1] and s2[0] == g2[0]))  # a single cell: a cardinal vertex conflict
+
+
+def classify_rectangle_conflict(s1, s2, g1, g2, rg):
+    """Return the type of the rectangle conflict: CARDINAL if both agents have
+    to leave it through its far corner rg, SEMI_CARDINAL if one of them has to,
+    NON_CARDINAL otherwise."""
+    if (s1[0] == s2[0] and (s1[1] - s2[1]) * (s2[1] - rg[1]) >= 0) or \
+            (s1[0] != s2[0] and (s1[0] - s2[0]) * (s2[0] - rg[0]) < 0):
+        cardinal1 = rg[0] == g1[0]
+        cardinal2 = rg[1] == g2[1]
+    else:
+        cardinal1 = rg[1] == g1[1]
+        cardinal2 = rg[0] == g2[0]
+    return [NON_CARDINAL, SEMI_CARDINAL, CARDINAL][cardinal1 + cardinal2]
+
+
+def get_rs(s1, s2, g1):
+    """Return the corner of the rectangle where the agents enter it."""
+    corner = []
+    for i in range(2):
+        if s1[i] == g1[i]:
+            corner.append(s1[i])
+        elif s1[i] < g1[i]:
+            corner.append(max(s1[i], s2[i]))
+        else:
+            corner.append(min(s1[i], s2[i]))
+    return tuple(corner)
+
+
+def get_rg(s1, g1, g2):
+    """Return the corner of the rectangle where the agents leave it."""
+    corner = []
+    for i in range(2):
+        if s1[i] == g1[i]:
+            corner.append(g1[i])
+        elif s1[i] < g1[i]:
+            corner.append(min(g1[i], g2[i]))
+        else:
+            corner.append(max(g1[i], g2[i]))
+    return tuple(corner)
+
+
+class RectangleReasoning(object):
+    """Rectangle reasoning of CBSH2-RTC (RM): two agents that move towards each
+    other's path across an open area have many pairs of paths of the same cost
+    that collide somewhere in the rectangle they share, and standard splitting
+    resolves them one cell at a time. A rectangle conflict is split instead
+    with two barrier constraints, each blocking one side of the rectangle to
+    one of the agents at the times it would cross it (see add_constraint)."""
+
+    def __init__(self, solver, wait_at_goal=True):
+        """solver           - CBSSolver whose collisions are examined
+        wait_at_goal        - agents stay at their goal after the end of their path,
+                              otherwise their goal cannot be in the rectangle
+        """
+        self.solver = solver
+        self.graph = solver.graph
+        self.wait_at_goal = wait_at_goal
+        self.num_rectangles = 0
+        self.runtime = 0
+
+    def run(self, node, collision, collision_type):
+        """Return the rectangle conflict that the collision of node belongs to
+        along with its type, or None. The conflict is a collision of type
+        'rectangle' whose 'constraints' split it."""
+        if collision['type'] != 'vertex' or collision_type == CARDINAL:
+            return None
+        start_time = timer.time()
+        rectangle = self.find_rectangle_conflict(node, collision)
+        self.runtime += timer.time() - start_time
+        if rectangle is not None:
+            self.num_rectangles += 1
+        return rectangle
+
+    def find_rectangle_conflict(self, node, collision):
+        a1 = collision['a1']
+        a2 = collision['a2']
+        timestep = collision['timestep']
+        paths = self.solver.get_paths(node)
+        path1 = paths[a1]
+        path2 = paths[a2]
+        if timestep >= len(path1) or timestep >= len(path2):
+            return None
+        mdd1 = self.solver.get_mdd(node, a1)
+        mdd2 = self.solver.get_mdd(node, a2)
+        if mdd1 is None or mdd2 is None:
+            return None
+        loc = path1[timestep]
+        # the segments of the paths around the collision that every path of
+        # the same cost follows, and that are Manhattan-optimal
+        s1s = self.get_start_candidates(path1, mdd1, timestep)
+        g1s = self.get_goal_candidates(path1, mdd1, timestep)
+        s2s = self.get_start_candidates(path2, mdd2, timestep)
+        g2s = self.get_goal_candidates(path2, mdd2, timestep)
+        best = None
+        best_type = None
+        best_area = 0
+        for t1_start in s1s:
+            for t1_end in g1s:
+                s1 = path1[t1_start]
+                g1 = path1[t1_end]
+                if manhattan_distance(s1, g1) != t1_end - t1_start:
+                    continue
+                for t2_start in s2s:
+                    for t2_end in g2s:
+                        s2 = path2[t2_start]
+                        g2 = path2[t2_end]
+                        if manhattan_distance(s2, g2) != t2_end - t2_start:
+                            continue
+                        if not is_rectangle_conflict(s1, s2, g1, g2):
+                            continue
+                        rg = get_rg(s1, g1, g2)
+                        rs = get_rs(s1, s2, g1)
+                        if not self.wait_at_goal and (self.in_rectangle(path1[-1], rs, rg) or
+                                                      self.in_rectangle(path2[-1], rs, rg)):
+                            continue  # the agent leaves the map in the rectangle
+                        area = (abs(rs[0] - rg[0]) + 1) * (abs(rs[1] - rg[1]) + 1)
+                        rectangle_type = classify_rectangle_conflict(s1, s2, g1, g2, rg)
+                        if best_type is not None and (rectangle_type > best_type or
+                                                      (rectangle_type == best_type and area <= best_area)):
+                            continue
+                        rg_t = timestep + manhattan_distance(rg, loc)
+                        constraints = self.get_barrier_constraints(a1, a2, rs, rg, s1, s2, rg_t,
+                                                                   mdd1, mdd2, path1, path2)
+                        if constraints is None:
+                            continue
+                        best = {'a1': a1, 'a2': a2, 'loc': [loc], 'timestep': timestep,
+                                'type': 'rectangle', 'constraints': constraints}
+                        best_type = rectangle_type
+                        best_area = area
+                        if best_type == CARDINAL:
+                            return best, best_type
+        if best is None:
+            return None
+        return best, best_type
+
+    @staticmethod
+    def in_rectangle(loc, rs, rg):
+        return min(rs[0], rg[0]) <= loc[0] <= max(rs[0], rg[0]) and min(rs[1], rg[1]) <= loc[1] <= max(rs[1], rg[1])
+
+    def get_start_candidates(self, path, mdd, timestep):
+        """Return the times before timestep at which every path of the MDD is at
+        the same cell, a Manhattan-optimal distance from the collision."""
+        return [t for t in range(timestep + 1)
+                if len(get_mdd_level(mdd, t)) == 1 and manhattan_distance(path[t], path[timestep]) == timestep - t]
+
+    def get_goal_candidates(self, path, mdd, timestep):
+        """Return the times after timestep at which every path of the MDD is at
+        the same cell, a Manhattan-optimal distance from the collision."""
+        return [t for t in range(len(path) - 1, timestep - 1, -1)
+                if len(get_mdd_level(mdd, t)) == 1 and manhattan_distance(path[t], path[timestep]) == t - timestep]
+
+    def get_barrier_constraints(self, a1, a2, rs, rg, s1, s2, rg_t, mdd1, mdd2, path1, path2):
+        """Return the barrier constraints of the two agents, or None if one of
+        their paths does not cross its barrier. Each agent is blocked along the
+        side of the rectangle that ends at rg and that the other agent enters
+        it through."""
+        # the agent that enters the rectangle through its side along the rows
+        # is blocked along its side along the columns, and the other way round
+        vertical_start = (rs[0], rg[1])
+        horizontal_start = (rg[0], rs[1])
+        if s1[0] == s2[0]:
+            first_vertical = (s1[1] - s2[1]) * (s2[1] - rg[1]) >= 0
+        else:
+            first_vertical = (s1[0] - s2[0]) * (s2[0] - rg[0]) < 0
+        if first_vertical:
+            starts = [vertical_start, horizontal_start]
+        else:
+            starts = [horizontal_start, vertical_start]
+        constraints = []
+        for agent, mdd, path, ri in zip([a1, a2], [mdd1, mdd2], [path1, path2], starts):
+            c = self.get_modified_barrier_constraint(agent, mdd, path, ri, rg, rg_t)
+            if c is None:
+                return None
+            constraints.append(c)
+        return constraints
+
+    def get_modified_barrier_constraint(self, agent, mdd, path, ri, rg, rg_t):
+        """Return the barrier constraint from ri to rg, reaching rg at rg_t, on
+        the part of the barrier that the MDD of the agent goes through (the
+        modified barrier of CBSH2-RTC) that path crosses. None if it crosses
+        none of it."""
+        ri_t = rg_t - manhattan_distance(ri, rg)
+        step = ((rg[0] > ri[0]) - (rg[0] < ri[0]), (rg[1] > ri[1]) - (rg[1] < ri[1]))
+        # the runs of consecutive cells of the barrier in the MDD: a path
+        # crosses the barrier once, so it is enough to block the run it crosses
+        first = None
+        last = None
+        for t in range(max(ri_t, 0), min(rg_t, len(mdd) - 1) + 1):
+            loc = (ri[0] + (t - ri_t) * step[0], ri[1] + (t - ri_t) * step[1])
+            if get_cell(self.graph, loc) in get_mdd_level(mdd, t):
+                if first is None:
+                    first = loc
+                last = (loc, t)
+                continue
+            if first is not None:
+                c = self.blocking_barrier(agent, path, first, last)
+                if c is not None:
+                    return c
+                first = None
+        if first is not None:
+            return self.blocking_barrier(agent, path, first, last)
+        return None
+
+    @staticmethod
+    def blocking_barrier(agent, path, first, last):
+        c = {'agent': agent,
+             'loc': [first, last[0]],
+             'timestep': last[1],
+             'positive': False,
+             'final': False,
+             'type': 'barrier'}
+        for loc, t in get_barrier_states(c):
+            if get_location(path, t) == loc:
+                return c
+        return None
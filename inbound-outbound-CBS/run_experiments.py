@@ -1,11 +1,17 @@
 #!/usr/bin/python
 import argparse
+import os
 import glob
 from pathlib import Path
 import random
 from cbs import CBSSolver
+from ecbs import SUBOPTIMALITY, ECBSSolver
 from visualize import Animation
 from single_agent_planner import get_sum_of_cost
+from heuristics import HEURISTICS_CACHE_DIR, HEURISTIC_MODES, LAZY_MEMORY_BUDGET, NUM_LANDMARKS, clear_heuristics_cache
+from cbs_heuristic import HIGH_LEVEL_HEURISTICS
+from station_assignment import STATION_LOAD_PENALTY
+from station_schedule import STATION_CAPACITY, STATION_THROUGHPUT
 
 SOLVER = "CBS"
 
@@ -106,9 +112,74 @@ if __name__ == '__main__':
     parser.add_argument('--disjoint', action='store_true', default=False,
                         help='Use the disjoint splitting')
     parser.add_argument('--solver', type=str, default=SOLVER,
-                        help='The solver to use (one of: {CBS,Independent,Prioritized}), defaults to ' + str(SOLVER))
+                        help='The solver to use (one of: {CBS,ECBS,EECBS}), defaults to ' + str(SOLVER))
+    parser.add_argument('--suboptimality', type=float, default=SUBOPTIMALITY,
+                        help='Factor of the lowest sum of costs that the solutions of ECBS and EECBS are within, '
+                             'defaults to ' + str(SUBOPTIMALITY))
+    parser.add_argument('--cache-dir', type=str, default=HEURISTICS_CACHE_DIR,
+                        help='Directory of the cached heuristic tables, defaults to ' + HEURISTICS_CACHE_DIR)
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Always recompute the heuristic tables')
+    parser.add_argument('--clear-cache', action='store_true', default=False,
+                        help='Remove the cached heuristic tables before running')
+    parser.add_argument('--heuristic', type=str, default='complete', choices=HEURISTIC_MODES,
+                        help='How the heuristic tables are built, defaults to complete')
+    parser.add_argument('--heuristic-memory', type=int, default=LAZY_MEMORY_BUDGET >> 20,
+                        help='Memory allowed for the per-goal heuristic tables of the lazy and landmark modes, in MB')
+    parser.add_argument('--landmarks', type=int, default=NUM_LANDMARKS,
+                        help='Number of landmarks of the landmark heuristic, defaults to ' + str(NUM_LANDMARKS))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes computing the heuristic tables of the complete mode, 0 for one per CPU')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the random choices of CBS (ties between conflicts), for reproducible runs')
+    parser.add_argument('--high-level-heuristic', type=str, default='none', choices=HIGH_LEVEL_HEURISTICS,
+                        help='h-values of the CBS nodes, defaults to none (fewest conflicts first)')
+    parser.add_argument('--no-bypass', action='store_true', default=False,
+                        help='Always split the CBS nodes, never adopt the paths of a child that costs the same')
+    parser.add_argument('--no-target-reasoning', action='store_true', default=False,
+                        help='Split the conflicts with an agent waiting at its goal one timestep at a time')
+    parser.add_argument('--rectangle-reasoning', action='store_true', default=False,
+                        help='Split the rectangle conflicts with barrier constraints')
+    parser.add_argument('--corridor-reasoning', action='store_true', default=False,
+                        help='Split the corridor conflicts with range constraints')
+    parser.add_argument('--no-conflict-avoidance', action='store_true', default=False,
+                        help='Break the ties between the shortest paths of an agent regardless of the other agents')
+    parser.add_argument('--merge-threshold', type=int, default=10,
+                        help='Conflicts between two agents after which they are merged and planned together '
+                             '(MA-CBS), negative to never merge, defaults to 10')
+    parser.add_argument('--order-goals', action='store_true', default=False,
+                        help='Visit the goals of each agent in the order of the shortest tour from its station')
+    parser.add_argument('--station-load-penalty', type=float, default=STATION_LOAD_PENALTY,
+                        help='Cost of a station to the agents assigned to it per other agent there, in timesteps, '
+                             'defaults to ' + str(STATION_LOAD_PENALTY))
+    parser.add_argument('--station-capacity', type=int, default=STATION_CAPACITY,
+                        help='Agents that a station holds at a timestep, the others queue upstream of it, '
+                             '0 for no limit, defaults to ' + str(STATION_CAPACITY))
+    parser.add_argument('--station-throughput', type=int, default=STATION_THROUGHPUT,
+                        help='Agents that enter a station in a timestep, 0 for no limit, '
+                             'defaults to ' + str(STATION_THROUGHPUT))
 
     args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.clear_cache:
+        clear_heuristics_cache(args.cache_dir)
+    solver_options = {'heuristic': args.heuristic,
+                      'cache_dir': cache_dir,
+                      'memory_budget': args.heuristic_memory << 20,
+                      'num_landmarks': args.landmarks,
+                      'workers': args.workers or os.cpu_count(),
+                      'seed': args.seed,
+                      'high_level_heuristic': args.high_level_heuristic,
+                      'bypass': not args.no_bypass,
+                      'target_reasoning': not args.no_target_reasoning,
+                      'rectangle_reasoning': args.rectangle_reasoning,
+                      'corridor_reasoning': args.corridor_reasoning,
+                      'conflict_avoidance': not args.no_conflict_avoidance,
+                      'merge_threshold': args.merge_threshold if args.merge_threshold >= 0 else None,
+                      'order_goals': args.order_goals,
+                      'station_load_penalty': args.station_load_penalty,
+                      'station_capacity': args.station_capacity or None,
+                      'station_throughput': args.station_throughput or None}
 
     result_file = open("results.csv", "w", buffering=1)
 
@@ -122,8 +193,15 @@ if __name__ == '__main__':
 
         if args.solver == "CBS":
             print("***Run CBS***")
-            cbs = CBSSolver(my_map, inbound_agents, outbound_agents)
+            cbs = CBSSolver(my_map, inbound_agents, outbound_agents, **solver_options)
             paths = cbs.find_solution(args.disjoint)
+        elif args.solver in ("ECBS", "EECBS"):
+            print("***Run {}***".format(args.solver))
+            solver = ECBSSolver(my_map, inbound_agents, outbound_agents, suboptimality=args.suboptimality,
+                                explicit_estimation=args.solver == "EECBS", **solver_options)
+            paths = solver.find_solution(args.disjoint)
+        else:
+            raise RuntimeError("Unknown solver!")
 
         cost = get_sum_of_cost(paths)
         save_paths_to_file(paths, file + '.paths')
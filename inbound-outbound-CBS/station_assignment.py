@@ -0,0 +1,52 @@
+# cost of a station to the agents assigned to it, in timesteps per other agent
+# at the station: the k-th agent of a station adds (k - 1) * STATION_LOAD_PENALTY
+STATION_LOAD_PENALTY = 2
+
+
+def assign_stations(costs, load_penalty=STATION_LOAD_PENALTY):
+    """Return the index of the station of each agent that minimises the sum of
+    the costs of the agents at their stations plus the load penalty of the
+    stations, load_penalty * k * (k - 1) / 2 for a station of k agents.
+    costs       - costs[agent][station], e.g. the distance between the station and the first
+                  or last waypoint of the agent
+
+    The agents are assigned one after the other by successive shortest paths:
+    the new agent takes the station that adds the least to the total cost,
+    possibly moving agents already assigned from one station to another, which
+    keeps the assignment of the agents so far optimal.
+    """
+    if not costs:
+        return []
+    num_stations = len(costs[0])
+    assignment = []
+    agents = [[] for _ in range(num_stations)]
+    for agent in range(len(costs)):
+        # Bellman-Ford over the stations: distance[station] is the lowest cost
+        # of taking a place at the station, the new agent going there, or to
+        # another station an agent assigned there leaves for it
+        distance = list(costs[agent])
+        parent = [None] * num_stations
+        for _ in range(num_stations - 1):
+            changed = False
+            for station in range(num_stations):
+                for other in agents[station]:
+                    for next_station in range(num_stations):
+                        d = distance[station] - costs[other][station] + costs[other][next_station]
+                        if d < distance[next_station]:
+                            distance[next_station] = d
+                            parent[next_station] = (station, other)
+                            changed = True
+            if not changed:
+                break
+        station = min(range(num_stations), key=lambda s: distance[s] + load_penalty * len(agents[s]))
+        # the agents along the path move to the station after them, and the
+        # new agent to the first station
+        while parent[station] is not None:
+            prev_station, other = parent[station]
+            agents[prev_station].remove(other)
+            agents[station].append(other)
+            assignment[other] = station
+            station = prev_station
+        agents[station].append(agent)
+        assignment.append(station)
+    return assignment
@@ -0,0 +1,122 @@
+from itertools import combinations
+
+# tours up to this number of goals are ordered exactly, by dynamic programming
+# over the subsets of the goals, the longer ones by local search
+EXACT_ORDER_LIMIT = 8
+# longest segment of goals that or-opt moves elsewhere in the tour
+OR_OPT_SEGMENT = 3
+
+
+def order_waypoints(distance, start, goals, end, precedence=()):
+    """Return the goals in the order of the shortest tour from start through
+    all of them to end.
+    distance        - distance(loc1, loc2), e.g. the distance method of a heuristic provider
+    precedence      - pairs (i, j) of indices of goals: goals[i] comes before goals[j] in the
+                      tour, e.g. a pick before the matching drop
+    Up to EXACT_ORDER_LIMIT goals, the tour is the shortest one (dynamic
+    programming, Held-Karp). Above, it is improved from a greedy tour by 2-opt
+    and or-opt moves until none of them shortens it.
+    """
+    if len(goals) < 2:
+        return list(goals)
+    # the indices of the goals that have to come before each goal
+    before = [0] * len(goals)
+    for i, j in precedence:
+        before[j] |= 1 << i
+    if len(goals) <= EXACT_ORDER_LIMIT:
+        order = get_exact_order(distance, start, goals, end, before)
+    else:
+        order = get_local_order(distance, start, goals, end, before)
+    return [goals[i] for i in order]
+
+
+def get_exact_order(distance, start, goals, end, before):
+    """Return the order of the indices of the goals of the shortest tour that
+    respects the precedence masks of before, see order_waypoints."""
+    n = len(goals)
+    # cost[mask][last] is the shortest tour from start through the goals of
+    # mask, ending at goals[last]
+    cost = [dict() for _ in range(1 << n)]
+    parent = [dict() for _ in range(1 << n)]
+    for i in range(n):
+        if before[i] == 0:
+            cost[1 << i][i] = distance(start, goals[i])
+    for size in range(1, n):
+        for subset in combinations(range(n), size):
+            mask = sum(1 << i for i in subset)
+            for last, last_cost in cost[mask].items():
+                for i in range(n):
+                    if mask & (1 << i) or before[i] & ~mask:
+                        continue
+                    child = mask | (1 << i)
+                    child_cost = last_cost + distance(goals[last], goals[i])
+                    if i not in cost[child] or child_cost < cost[child][i]:
+                        cost[child][i] = child_cost
+                        parent[child][i] = last
+    full = (1 << n) - 1
+    if not cost[full]:
+        raise BaseException('The precedence constraints of the goals have a cycle')
+    last = min(cost[full], key=lambda i: cost[full][i] + distance(goals[i], end))
+    order = []
+    mask = full
+    while mask:
+        order.append(last)
+        last, mask = parent[mask].get(last), mask & ~(1 << last)
+    order.reverse()
+    return order
+
+
+def get_local_order(distance, start, goals, end, before):
+    """Return an order of the indices of the goals that respects the
+    precedence masks of before, from the nearest goal first, improved by 2-opt
+    and or-opt moves, see order_waypoints."""
+    n = len(goals)
+    order = []
+    mask = 0
+    loc = start
+    while len(order) < n:
+        candidates = [i for i in range(n) if not mask & (1 << i) and not before[i] & ~mask]
+        if not candidates:
+            raise BaseException('The precedence constraints of the goals have a cycle')
+        i = min(candidates, key=lambda i: distance(loc, goals[i]))
+        order.append(i)
+        mask |= 1 << i
+        loc = goals[i]
+
+    def tour_cost(tour):
+        locs = [start] + [goals[i] for i in tour] + [end]
+        return sum(distance(locs[k], locs[k + 1]) for k in range(len(locs) - 1))
+
+    def is_feasible(tour):
+        mask = 0
+        for i in tour:
+            if before[i] & ~mask:
+                return False
+            mask |= 1 << i
+        return True
+
+    best = tour_cost(order)
+    improved = True
+    while improved:
+        improved = False
+        candidates = []
+        # 2-opt: reverse a segment of the tour
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                candidates.append(order[:i] + order[i:j + 1][::-1] + order[j + 1:])
+        # or-opt: move a segment of up to OR_OPT_SEGMENT goals elsewhere
+        for length in range(1, min(OR_OPT_SEGMENT, n - 1) + 1):
+            for i in range(n - length + 1):
+                segment = order[i:i + length]
+                rest = order[:i] + order[i + length:]
+                for j in range(len(rest) + 1):
+                    if j != i:
+                        candidates.append(rest[:j] + segment + rest[j:])
+        for tour in candidates:
+            cost = tour_cost(tour)
+            if cost < best and is_feasible(tour):
+                order = tour
+                best = cost
+                improved = True
+                break
+    return order
@@ -0,0 +1,258 @@
+import time as timer
+from mdd import CARDINAL, joint_mdd_exists
+from single_agent_planner import get_cell
+
+# high-level heuristics, the open list is ordered by cost + h with all but none:
+#   none    - the nodes with the fewest collisions first, then the cheapest (not admissible)
+#   zero    - h = 0, the cheapest nodes first
+#   CG      - minimum vertex cover of the cardinal conflict graph
+#   DG      - minimum vertex cover of the pairwise dependency graph
+#   WDG     - minimum weighted vertex cover of the weighted dependency graph
+HIGH_LEVEL_HEURISTICS = ['none', 'zero', 'CG', 'DG', 'WDG']
+# components of the graph up to this number of agents get an exact cover, the
+# larger ones the lower bound of a greedy matching
+DP_NODE_THRESHOLD = 8
+# expansions of the CBS searches on two agents of the WDG heuristic, after
+# which the lowest cost left in their open list is used as the weight
+TWO_AGENT_NODE_LIMIT = 10
+
+
+def get_components(edges):
+    """Return the connected components of the graph of edges, a dict
+    {(agent1, agent2): weight}, as lists of agents."""
+    neighbors = dict()
+    for a1, a2 in edges:
+        neighbors.setdefault(a1, []).append(a2)
+        neighbors.setdefault(a2, []).append(a1)
+    components = []
+    done = set()
+    for root in sorted(neighbors):
+        if root in done:
+            continue
+        done.add(root)
+        component = [root]
+        for agent in component:
+            for other in neighbors[agent]:
+                if other not in done:
+                    done.add(other)
+                    component.append(other)
+        components.append(component)
+    return components
+
+
+def greedy_matching(edges):
+    """Return the weight of a matching of the graph, taking the heaviest edges
+    first: a lower bound of the (weighted) minimum vertex cover."""
+    weight = 0
+    used = set()
+    for (a1, a2), w in sorted(edges.items(), key=lambda edge: -edge[1]):
+        if a1 not in used and a2 not in used:
+            used.add(a1)
+            used.add(a2)
+            weight += w
+    return weight
+
+
+def k_vertex_cover(edges, k):
+    """Return True if k agents cover all the edges (a set of pairs)."""
+    if len(edges) == 0:
+        return True
+    if k == 0:
+        return False
+    # one of the two agents of any edge is in the cover
+    for agent in next(iter(edges)):
+        if k_vertex_cover({edge for edge in edges if agent not in edge}, k - 1):
+            return True
+    return False
+
+
+def minimum_vertex_cover(edges):
+    """Return the size of the minimum vertex cover of the graph of edges, a dict
+    {(agent1, agent2): weight} whose weights are ignored."""
+    cover = 0
+    for component in get_components(edges):
+        agents = set(component)
+        component_edges = {edge for edge in edges if edge[0] in agents}
+        if len(component) == 2:
+            cover += 1
+        elif len(component) > DP_NODE_THRESHOLD:
+            cover += greedy_matching({edge: 1 for edge in component_edges})
+        else:
+            k = 1
+            while not k_vertex_cover(component_edges, k):
+                k += 1
+            cover += k
+    return cover
+
+
+def weighted_vertex_cover(agents, weights, ranges, x, i, total, best):
+    """Branch and bound over the values x of the agents in order: the value of
+    agent i is at least the weight of its edges to the agents before it minus
+    their values, at most its heaviest edge. Return the lowest sum of values
+    below best."""
+    if total >= best:
+        return best
+    if i == len(agents):
+        return total
+    agent = agents[i]
+    lowest = 0
+    for j in range(i):
+        lowest = max(lowest, weights.get((agents[j], agent), 0) - x[j])
+    for value in range(lowest, ranges[agent] + 1):
+        x[i] = value
+        best = weighted_vertex_cover(agents, weights, ranges, x, i + 1, total + value, best)
+    return best
+
+
+def minimum_weighted_vertex_cover(edges):
+    """Return the minimum weighted vertex cover of the graph of edges, a dict
+    {(agent1, agent2): weight}: the lowest sum of non-negative values of the
+    agents such that the values of the two agents of each edge add up to at
+    least its weight."""
+    cover = 0
+    for component in get_components(edges):
+        agents = set(component)
+        component_edges = {edge: w for edge, w in edges.items() if edge[0] in agents}
+        if len(component) == 2:
+            cover += sum(component_edges.values())
+        elif len(component) > DP_NODE_THRESHOLD:
+            cover += greedy_matching(component_edges)
+        else:
+            weights = dict()
+            ranges = dict.fromkeys(component, 0)
+            for (a1, a2), w in component_edges.items():
+                weights[(a1, a2)] = weights[(a2, a1)] = w
+                ranges[a1] = max(ranges[a1], w)
+                ranges[a2] = max(ranges[a2], w)
+            upper_bound = sum(component_edges.values())
+            cover += weighted_vertex_cover(component, weights, ranges, [0] * len(component), 0, 0, upper_bound + 1)
+    return cover
+
+
+class CBSHeuristic(object):
+    """The high-level heuristics of CBSH: a lower bound on the cost that the
+    descendants of a node add to its cost, from the graph of the pairs of agents
+    that cannot both keep their costs. The edges of a pair are memoised by the
+    constraints and waypoints of its two agents, so the nodes that share them
+    do not test the pair again."""
+
+    def __init__(self, solver, mode, wait_at_goal=True):
+        """solver           - CBSSolver whose nodes are evaluated
+        mode                - one of HIGH_LEVEL_HEURISTICS
+        wait_at_goal        - agents collide with the agents waiting at their goal, see mdd.joint_mdd_exists
+        """
+        if mode not in HIGH_LEVEL_HEURISTICS:
+            raise RuntimeError('Unknown high-level heuristic ' + str(mode))
+        self.solver = solver
+        self.mode = mode
+        self.wait_at_goal = wait_at_goal
+        self.stations = frozenset(get_cell(solver.graph, loc) for loc in solver.stations)
+        # the h-values of CG, DG and WDG are computed when the nodes are popped
+        self.informed = mode in ['CG', 'DG', 'WDG']
+        # weights of the pairs of agents, see get_pair_key
+        self.lookup_table = dict()
+
+        # statistics, as reported by CBSH2-RTC
+        self.num_merge_mdds = 0
+        self.num_solve_2agent_problems = 0
+        self.num_memoization = 0
+        self.runtime_build_dependency_graph = 0
+        self.runtime_solve_mvc = 0
+
+    def compute(self, node):
+        """Return the h-value of node, or None if the node has no solution (two
+        of its agents cannot reach their goals together). The edges of the
+        graph are kept in node['conflict_graph']."""
+        start_time = timer.time()
+        if self.mode == 'CG':
+            edges = self.build_cardinal_conflict_graph(node)
+        elif self.mode == 'DG':
+            edges = self.build_dependency_graph(node)
+        elif self.mode == 'WDG':
+            edges = self.build_weighted_dependency_graph(node)
+        else:
+            edges = dict()
+        node['conflict_graph'] = edges
+        if edges is None:
+            self.runtime_build_dependency_graph += timer.time() - start_time
+            return None
+        mvc_start_time = timer.time()
+        self.runtime_build_dependency_graph += mvc_start_time - start_time
+        if self.mode == 'WDG':
+            h = minimum_weighted_vertex_cover(edges)
+        else:
+            h = minimum_vertex_cover(edges)
+        self.runtime_solve_mvc += timer.time() - mvc_start_time
+        return h
+
+    def build_cardinal_conflict_graph(self, node):
+        edges = dict()
+        for collision, collision_type in self.solver.classify_collisions(node):
+            if collision_type == CARDINAL:
+                edges[(collision['a1'], collision['a2'])] = 1
+        return edges
+
+    def inherit_edges(self, node):
+        """Return the edges of the parent of node between the agents that node
+        did not replan: their paths and MDDs did not change."""
+        parent = node['parent']
+        if parent is None or parent.get('conflict_graph') is None:
+            return dict()
+        return {(a1, a2): w for (a1, a2), w in parent['conflict_graph'].items()
+                if a1 not in node['replanned'] and a2 not in node['replanned']}
+
+    def get_pair_key(self, node, a1, a2):
+        paths = self.solver.get_paths(node)
+        return (a1, a2,
+                tuple(self.solver.get_waypoints(a1, paths[a1])), self.solver.get_constraint_table(node, a1)['constraints'],
+                tuple(self.solver.get_waypoints(a2, paths[a2])), self.solver.get_constraint_table(node, a2)['constraints'])
+
+    def build_dependency_graph(self, node):
+        edges = self.inherit_edges(node)
+        for collision, collision_type in self.solver.classify_collisions(node):
+            pair = (collision['a1'], collision['a2'])
+            if collision_type == CARDINAL:
+                edges[pair] = 1
+            elif pair not in edges:
+                key = self.get_pair_key(node, *pair)
+                if key in self.lookup_table:
+                    self.num_memoization += 1
+                else:
+                    self.lookup_table[key] = 1 if self.dependent(node, *pair) else 0
+                edges[pair] = self.lookup_table[key]
+        return {pair: w for pair, w in edges.items() if w > 0}
+
+    def build_weighted_dependency_graph(self, node):
+        edges = self.inherit_edges(node)
+        for collision, collision_type in self.solver.classify_collisions(node):
+            pair = (collision['a1'], collision['a2'])
+            if pair in edges:
+                continue
+            key = self.get_pair_key(node, *pair)
+            if key in self.lookup_table:
+                self.num_memoization += 1
+            else:
+                # only the dependent agents are worth a search on two agents
+                cardinal = collision_type == CARDINAL
+                if cardinal or self.dependent(node, *pair):
+                    self.num_solve_2agent_problems += 1
+                    weight = self.solver.solve_two_agents(node, pair[0], pair[1], TWO_AGENT_NODE_LIMIT)
+                    if weight is not None and cardinal:
+                        weight = max(weight, 1)
+                else:
+                    weight = 0
+                self.lookup_table[key] = weight
+            if self.lookup_table[key] is None:
+                return None  # the two agents have no solution
+            edges[pair] = self.lookup_table[key]
+        return {pair: w for pair, w in edges.items() if w > 0}
+
+    def dependent(self, node, a1, a2):
+        """Return True if the two agents cannot both follow a path of their MDD
+        without colliding."""
+        self.num_merge_mdds += 1
+        mdd1 = self.solver.get_mdd(node, a1)
+        mdd2 = self.solver.get_mdd(node, a2)
+        if mdd1 is None or mdd2 is None:
+            return False
+        return not joint_mdd_exists(mdd1, mdd2, self.stations, self.wait_at_goal)
@@ -0,0 +1,316 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from array import array
+import numpy as np
+from single_agent_planner import UNREACHABLE, DistanceTable, compute_distance_matrix, compute_heuristics, get_cell
+
+# ways of providing the h_values of a goal to a_star:
+#   complete - all-pairs distance matrix, computed (or loaded from the cache) upfront
+#   lazy     - one table per goal, computed the first time the goal is requested
+#   landmark - lower bounds derived from the distances to a few landmark cells
+HEURISTIC_MODES = ['complete', 'lazy', 'landmark']
+
+# distance tables are cached on disk, one .npy file per map, so that runs on the
+# same layout (and the worker processes of a run) do not recompute them
+HEURISTICS_CACHE_DIR = os.environ.get('MAPF_HEURISTICS_CACHE',
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), '.heuristics_cache'))
+# the least recently used tables are evicted when the cache grows above this size
+HEURISTICS_CACHE_MAX_BYTES = 1 << 30
+# memory used by the per-goal tables of the lazy mode, in bytes
+LAZY_MEMORY_BUDGET = 256 << 20
+# landmarks of the landmark mode
+NUM_LANDMARKS = 16
+# the rows of the distance matrix are split in this many chunks per worker,
+# so that the workers stay busy when some rows take longer than others
+CHUNKS_PER_WORKER = 4
+# bump when the layout of the cached tables changes, to invalidate older files
+CACHE_VERSION = 1
+
+
+def map_hash(graph):
+    """Return a content hash of the map: only the obstacles matter for the distances."""
+    digest = hashlib.sha1()
+    digest.update('v{} {} {}\n'.format(CACHE_VERSION, graph['rows'], graph['cols']).encode())
+    digest.update(bytes(graph['free']))
+    return digest.hexdigest()
+
+
+def cache_size(cache_dir=HEURISTICS_CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith('.npy'))
+
+
+def evict_heuristics_cache(cache_dir=HEURISTICS_CACHE_DIR, max_bytes=HEURISTICS_CACHE_MAX_BYTES):
+    """Remove the least recently used tables until the cache fits in max_bytes."""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.npy')]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= entry.stat().st_size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:  # already evicted by another process
+            pass
+
+
+def clear_heuristics_cache(cache_dir=HEURISTICS_CACHE_DIR):
+    """Invalidate the cache: remove every cached table."""
+    evict_heuristics_cache(cache_dir, 0)
+
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _fill_rows(name, first, last):
+    """Compute the rows first..last-1 of the distance matrix, in the shared block."""
+    n = _worker_graph['num_cells']
+    shared_memory = SharedMemory(name)
+    try:
+        matrix = np.ndarray((n, n), dtype=np.uint16, buffer=shared_memory.buf)
+        compute_distance_matrix(_worker_graph, first, last, matrix[first:last])
+        del matrix  # the block cannot be closed while a view of it exists
+    finally:
+        shared_memory.close()
+
+
+def compute_shared_distance_matrix(graph, workers):
+    """Compute the all-pairs distance matrix (see compute_distance_matrix) with a
+    pool of worker processes, each filling a range of rows of one shared-memory
+    block. Return the block, already unlinked: it is freed once closed."""
+    n = graph['num_cells']
+    shared_memory = SharedMemory(create=True, size=max(1, 2 * n * n))
+    try:
+        # split the rows so that the chunks have the same number of free cells
+        num_free = np.cumsum(graph['free'])
+        num_chunks = max(1, min(workers * CHUNKS_PER_WORKER, int(num_free[-1])))
+        bounds = np.searchsorted(num_free, np.linspace(0, num_free[-1], num_chunks + 1)[1:-1], side='right')
+        bounds = [0] + sorted(set(bounds.tolist())) + [n]
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(graph,)) as executor:
+            futures = [executor.submit(_fill_rows, shared_memory.name, first, last)
+                       for first, last in zip(bounds[:-1], bounds[1:]) if first < last]
+            for future in futures:
+                future.result()
+    except BaseException:
+        shared_memory.close()
+        shared_memory.unlink()
+        raise
+    shared_memory.unlink()
+    return shared_memory
+
+
+class SharedDistanceTable(DistanceTable):
+    """A DistanceTable over a matrix in a shared-memory block, which it owns."""
+
+    def __init__(self, graph, shared_memory):
+        n = graph['num_cells']
+        super().__init__(graph, np.ndarray((n, n), dtype=np.uint16, buffer=shared_memory.buf))
+        self.shared_memory = shared_memory
+
+    def close(self):
+        if self.shared_memory is not None:
+            self.matrix = None
+            self.shared_memory.close()
+            self.shared_memory = None
+
+    def __del__(self):
+        self.close()
+
+
+def load_distance_matrix(graph, cache_dir=HEURISTICS_CACHE_DIR, max_bytes=HEURISTICS_CACHE_MAX_BYTES, workers=1):
+    """Return the all-pairs distance matrix of the map (see compute_distance_matrix).
+    A cached table is memory-mapped read-only instead of being recomputed;
+    otherwise the table is computed and written to the cache.
+    cache_dir   - cache directory, None to disable the cache
+    max_bytes   - size of the cache above which old tables are evicted
+    workers     - processes computing the table, see compute_shared_distance_matrix
+    """
+    if cache_dir is None:
+        return compute_distance_matrix(graph)
+    path = os.path.join(cache_dir, map_hash(graph) + '.npy')
+    n = graph['num_cells']
+    try:
+        matrix = np.load(path, mmap_mode='r')
+        if matrix.shape == (n, n) and matrix.dtype == np.uint16:
+            os.utime(path)  # mark as recently used
+            return matrix
+    except (OSError, ValueError):  # missing or unreadable file
+        pass
+
+    if workers > 1:
+        table = SharedDistanceTable(graph, compute_shared_distance_matrix(graph, workers))
+        matrix = table.matrix
+    else:
+        table = None
+        matrix = compute_distance_matrix(graph)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first, so that other processes never load a partial table
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, matrix)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+    evict_heuristics_cache(cache_dir, max_bytes)
+    if table is not None:
+        # the shared block is released in favour of the file, mapped the same way
+        del matrix
+        table.close()
+        return np.load(path, mmap_mode='r')
+    return matrix
+
+
+def load_heuristics(graph, cache_dir=HEURISTICS_CACHE_DIR, max_bytes=HEURISTICS_CACHE_MAX_BYTES, workers=1):
+    """Same as compute_heuristics_for_complete_map, going through the cache.
+    With more than one worker and no cache, the solver uses the shared block
+    the workers wrote to directly."""
+    if cache_dir is None and workers > 1:
+        return SharedDistanceTable(graph, compute_shared_distance_matrix(graph, workers))
+    return DistanceTable(graph, load_distance_matrix(graph, cache_dir, max_bytes, workers))
+
+
+class LazyHeuristics(object):
+    """Per-goal distance tables, computed the first time a goal is requested and
+    kept in a least-recently-used cache that fits in memory_budget bytes. Only
+    the goals that are actually planned for are paid for."""
+
+    def __init__(self, graph, memory_budget=LAZY_MEMORY_BUDGET):
+        """graph            - compiled map, as returned by compile_map
+        memory_budget       - memory allowed for the cached tables, in bytes
+        """
+        self.graph = graph
+        self.tables = OrderedDict()
+        # every table is a uint16 array over all the cells of the map
+        self.max_tables = max(1, memory_budget // (2 * graph['num_cells']))
+        self.num_computed = 0
+        self.num_evicted = 0
+
+    def __getitem__(self, goal):
+        """Return the h_values of the goal location, as a_star expects them."""
+        cell = get_cell(self.graph, goal)
+        h_values = self.tables.get(cell)
+        if h_values is not None:
+            self.tables.move_to_end(cell)
+            return h_values
+        h_values = self.compute_table(goal)
+        self.num_computed += 1
+        self.tables[cell] = h_values
+        if len(self.tables) > self.max_tables:
+            self.tables.popitem(last=False)
+            self.num_evicted += 1
+        return h_values
+
+    def compute_table(self, goal):
+        return compute_heuristics(self.graph, goal)
+
+    def distance(self, loc1, loc2):
+        return self[loc2][get_cell(self.graph, loc1)]
+
+
+class LandmarkHeuristics(LazyHeuristics):
+    """Differential heuristic: the exact distances to num_landmarks landmark
+    cells are stored, and h(cell) = max over the landmarks L of
+    |d(L, goal) - d(L, cell)|, a lower bound by the triangle inequality.
+    Only num_landmarks tables are kept per map, whatever the number of goals;
+    the table of a goal is derived from them when the goal is requested, and
+    kept in the same LRU cache as the lazy mode."""
+
+    def __init__(self, graph, memory_budget=LAZY_MEMORY_BUDGET, num_landmarks=NUM_LANDMARKS):
+        """graph            - compiled map, as returned by compile_map
+        memory_budget       - memory allowed for the landmark and cached tables, in bytes
+        num_landmarks       - number of landmarks
+        """
+        self.landmarks = select_landmarks(graph, num_landmarks)
+        self.distances = np.array([compute_heuristics(graph, graph['locs'][landmark])
+                                   for landmark in self.landmarks], dtype=np.int32)
+        memory_budget -= len(self.landmarks) * 2 * graph['num_cells']
+        super().__init__(graph, memory_budget)
+
+    def compute_table(self, goal):
+        if len(self.landmarks) == 0:
+            return array('H', [0]) * self.graph['num_cells']
+        goal_distances = self.distances[:, get_cell(self.graph, goal), None]
+        h_values = np.abs(self.distances - goal_distances)
+        # a landmark that reaches only one of the two cells proves that they are
+        # in different components, one that reaches neither gives no bound
+        unreachable = self.distances == UNREACHABLE
+        goal_unreachable = goal_distances == UNREACHABLE
+        h_values[unreachable != goal_unreachable] = UNREACHABLE
+        h_values[unreachable & goal_unreachable] = 0
+        return array('H', h_values.max(axis=0).astype(np.uint16).tobytes())
+
+
+def largest_component(graph):
+    """Return the cells of the largest connected component of the map."""
+    offsets = graph['offsets']
+    neighbors = graph['neighbors']
+    visited = bytearray(graph['num_cells'])
+    largest = []
+    for root in range(graph['num_cells']):
+        if visited[root] or not graph['free'][root]:
+            continue
+        visited[root] = 1
+        component = [root]
+        open_list = deque([root])
+        while len(open_list) > 0:
+            cell = open_list.popleft()
+            for child_cell in neighbors[offsets[cell] + 1:offsets[cell + 1]]:
+                if not visited[child_cell]:
+                    visited[child_cell] = 1
+                    component.append(child_cell)
+                    open_list.append(child_cell)
+        if len(component) > len(largest):
+            largest = component
+    return largest
+
+
+def select_landmarks(graph, num_landmarks):
+    """Return up to num_landmarks cells spread over the map by farthest-point
+    selection: each landmark is the cell farthest from the previous ones.
+    The landmarks are taken in the largest connected component: the other
+    components of a map are usually a few cells walled in by obstacles, where
+    the searches are short whatever the heuristic. Their cells still get the
+    UNREACHABLE bound from the goals of the largest component and vice versa."""
+    component = np.array(sorted(largest_component(graph)), dtype=np.int64)
+    landmarks = []
+    if num_landmarks <= 0 or component.size == 0:
+        return landmarks
+    # seed the selection with the distances from an arbitrary cell, which is
+    # not a landmark itself: the first landmark ends up on the edge of the map
+    nearest = np.asarray(compute_heuristics(graph, graph['locs'][component[0]]))[component]
+    while len(landmarks) < num_landmarks:
+        i = int(np.argmax(nearest))
+        if nearest[i] == 0:  # every cell is a landmark
+            break
+        landmark = int(component[i])
+        landmarks.append(landmark)
+        distances = np.asarray(compute_heuristics(graph, graph['locs'][landmark]))[component]
+        nearest = np.minimum(nearest, distances)
+    return landmarks
+
+
+def build_heuristics(graph, mode='complete', cache_dir=HEURISTICS_CACHE_DIR, memory_budget=LAZY_MEMORY_BUDGET,
+                     num_landmarks=NUM_LANDMARKS, workers=1):
+    """Return the heuristic provider of the given mode (see HEURISTIC_MODES):
+    provider[goal] gives the h_values of a goal location for a_star.
+    cache_dir       - cache directory of the complete mode, None to disable the cache
+    memory_budget   - memory allowed for the tables of the lazy and landmark modes, in bytes
+    num_landmarks   - number of landmarks of the landmark mode
+    workers         - processes computing the tables of the complete mode
+    """
+    if mode == 'complete':
+        return load_heuristics(graph, cache_dir, workers=workers)
+    elif mode == 'lazy':
+        return LazyHeuristics(graph, memory_budget)
+    elif mode == 'landmark':
+        return LandmarkHeuristics(graph, memory_budget, num_landmarks)
+    raise RuntimeError('Unknown heuristic mode ' + str(mode))
@@ -37,7 +37,7 @@ def get_new_goal(layout, goals):
 
 
 # Visualize the robot movement with collision avoidance
-def visualize_movement(layout, robots: int):
+def visualize_movement(layout, robots: int, **solver_options):
     plt.ion()  # Turn on interactive mode
     HEIGHT = len(layout)
     WIDTH = len(layout[0])
@@ -47,7 +47,7 @@ def visualize_movement(layout, robots: int):
     for i in range(robots):
         goal = get_new_goal(layout, goals)
         goals.append(goal)
-    cbs = CBSSolver(layout, goals)
+    cbs = CBSSolver(layout, goals, **solver_options)
     clear_results()
     start_time = time.time()
     paths = cbs.find_solution()
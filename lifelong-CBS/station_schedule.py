@@ -0,0 +1,120 @@
+# agents that a station holds at a timestep, and that enter it in a timestep,
+# None for no limit
+STATION_CAPACITY = 1
+STATION_THROUGHPUT = 1
+
+
+def schedule_releases(starts, stations, capacity=STATION_CAPACITY, throughput=STATION_THROUGHPUT):
+    """Return the release slot of each agent: the timestep at which it enters
+    its start location, a station, from the queue upstream of it, 0 if it does
+    not start at a station. The agents of a station are released in turn, in
+    the order of the agents, at most min(capacity, throughput) per timestep.
+    starts      - first location of the path of each agent, None if it has no path
+    stations    - set of the station locations
+    """
+    per_timestep = min(limit for limit in (capacity, throughput, float('inf')) if limit is not None)
+    queues = dict()
+    releases = []
+    for loc in starts:
+        if loc in stations:
+            position = queues.get(loc, 0)
+            queues[loc] = position + 1
+            releases.append(int(position // per_timestep))
+        else:
+            releases.append(0)
+    return releases
+
+
+def get_release_constraints(agent, loc, release):
+    """Return the constraints that keep agent in the queue of its start
+    location loc until its release slot (see schedule_releases)."""
+    if release == 0:
+        return []
+    return [{'agent': agent,
+             'loc': [loc],
+             'timestep': release,
+             'positive': False,
+             'final': False,
+             'type': 'release'}]
+
+
+def get_station_visits(paths, releases, stations):
+    """Return the agents on each station at each timestep: (station, timestep)
+    maps to the pairs (agent, entry), where entry is 'release' if the agent
+    enters the station from its queue at this timestep, 'arrival' if it moves
+    there from another location, None if it was already there. An agent is in
+    the queue before its release slot, and leaves the floor when its path ends
+    at a station, so it is not on the station then."""
+    visits = dict()
+    for agent, path in enumerate(paths):
+        release = releases[agent]
+        for t in range(release, len(path)):
+            loc = path[t]
+            if loc not in stations:
+                continue
+            if t == release:
+                entry = 'release'
+            elif path[t - 1] != loc:
+                entry = 'arrival'
+            else:
+                entry = None
+            visits.setdefault((loc, t), []).append((agent, entry))
+    return visits
+
+
+def detect_station_conflicts(paths, releases, stations, capacity=STATION_CAPACITY, throughput=STATION_THROUGHPUT):
+    """Return the station conflicts of the paths, in the order of their
+    timesteps: a station holds more than capacity agents at a timestep, or
+    more than throughput agents enter it. A conflict is a collision of type
+    'station' whose 'constraints' split it, one child per agent of 'agents'.
+    The agents released at the timestep cannot avoid the station, so the
+    children keep one more of the others off it than the capacity leaves room
+    for (or from entering it, for the throughput): at least one of them has to
+    avoid it in every solution. 'a1' and 'a2' are the first two of the agents
+    on the station."""
+    if capacity is None and throughput is None:
+        return []
+    conflicts = []
+    visits = get_station_visits(paths, releases, stations)
+    for (loc, t), visitors in sorted(visits.items(), key=lambda item: (item[0][1], item[0][0])):
+        released = [agent for agent, entry in visitors if entry == 'release']
+        arrived = [agent for agent, entry in visitors if entry == 'arrival']
+        if capacity is not None and len(visitors) > capacity:
+            agents = [agent for agent, entry in visitors if entry != 'release']
+            limit = capacity
+            constraint_type = 'station'
+        elif throughput is not None and len(released) + len(arrived) > throughput:
+            agents = arrived
+            limit = throughput
+            constraint_type = 'arrival'
+        else:
+            continue
+        if len(released) > limit:
+            continue  # more agents released than the station takes, see schedule_releases
+        agents = agents[:limit - len(released) + 1]
+        conflicts.append({'a1': visitors[0][0],
+                          'a2': visitors[1][0],
+                          'agents': agents,
+                          'loc': [loc],
+                          'timestep': t,
+                          'type': 'station',
+                          'constraints': [{'agent': agent,
+                                           'loc': [loc],
+                                           'timestep': t,
+                                           'positive': False,
+                                           'final': False,
+                                           'type': constraint_type} for agent in agents]})
+    return conflicts
+
+
+def get_station_statistics(paths, releases, stations):
+    """Return, for each station that the agents use, the number of agents that
+    enter it, the most agents on it at a timestep, and its throughput, the
+    agents that enter it per timestep over the makespan of the paths."""
+    makespan = max((len(path) - 1 for path in paths), default=0)
+    entries = dict()
+    peaks = dict()
+    for (loc, t), visitors in get_station_visits(paths, releases, stations).items():
+        entries[loc] = entries.get(loc, 0) + sum(1 for _, entry in visitors if entry is not None)
+        peaks[loc] = max(peaks.get(loc, 0), len(visitors))
+    return {loc: (entries[loc], peaks[loc], entries[loc] / max(makespan, 1)) for loc in sorted(entries)}